@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 
-import logging, os
-import logging.handlers
+import os
 
-from flask import (Flask, has_request_context, redirect, render_template,
-                   url_for, request)
+from flask import Flask, render_template, session
 
-import db, db_funcs, mail, polls, search
+import cache, closer, db, db_funcs, hashing, ingest, live, logs, mail
+import maintenance, metrics, migrations, polls, search, seed, slowlog, worker
 
 app = Flask(__name__, instance_relative_config=True)
 
@@ -18,6 +17,67 @@ class DefaultConfig:
     SENDGRID_API_KEY="placeholder_key"
     SENDGRID_DEFAULT_FROM="noreply@stickpoll.com"
     UPDATE_INTERVAL=60
+    TALLY_BACKEND="auto"
+    NUMPY_TALLY_THRESHOLD=50000
+    RESULTS_WORKER="thread"
+    DB_BUSY_TIMEOUT=5000
+    DB_POOL_SIZE=8
+    DB_STATEMENT_CACHE_SIZE=100
+    DB_JOURNAL_MODE="WAL"
+    DB_SYNCHRONOUS="NORMAL"
+    DB_CACHE_SIZE=-16000
+    DB_MMAP_SIZE=64*1024*1024
+    VOTE_INGEST="direct"
+    VOTE_BATCH_SIZE=200
+    VOTE_BATCH_LATENCY=0.05
+    VOTE_WAIT_FOR_COMMIT=True
+    VOTE_COMMIT_TIMEOUT=10
+    POLL_CACHE_SIZE=1024
+    POLL_CACHE_TTL=60
+    SEARCH_PAGE_SIZE=50
+    SEARCH_CACHE_SIZE=512
+    SEARCH_CACHE_TTL=300
+    HOME_CACHE_TTL=30
+    SESSION_MODE="db"
+    SESSION_RECHECK_INTERVAL=60*60
+    COOKIE_RETENTION=90*24*60*60
+    COOKIE_TOUCH_INTERVAL=24*60*60
+    MAINTENANCE_INTERVAL=0
+    MAINTENANCE_CHUNK_SIZE=500
+    MAINTENANCE_PAUSE=0.05
+    HASH_SCRYPT_N=2**15
+    HASH_SCRYPT_R=8
+    HASH_SCRYPT_P=1
+    HASH_WORKERS=2
+    HASH_QUEUE_LIMIT=8
+    HASH_TIMEOUT=10
+    MAIL_TRANSPORT="sendgrid"
+    MAIL_FILE_DIRECTORY=os.path.join(app.instance_path, "mail")
+    MAIL_SENDER="thread"
+    MAIL_BATCH_SIZE=20
+    MAIL_POLL_INTERVAL=30
+    MAIL_MAX_ATTEMPTS=8
+    MAIL_RETRY_DELAY=30
+    MAIL_CLAIM_TIMEOUT=5*60
+    MAIL_RETENTION=7*24*60*60
+    POLL_CLOSER="thread"
+    CLOSER_RELOAD_INTERVAL=5*60
+    FINAL_RESULTS_MAX_AGE=24*60*60
+    LIVE_POLL_INTERVAL=2
+    LIVE_KEEPALIVE=15
+    LIVE_MAX_SUBSCRIBERS=100
+    SEED_BATCH_SIZE=1000
+    METRICS_ENABLED=False
+    METRICS_LOG_THRESHOLD=1.0
+    METRICS_ALLOWED_IPS=("127.0.0.1", "::1")
+    METRICS_TOKEN=None
+    SLOW_QUERY_THRESHOLD=0
+    SLOW_QUERY_LOG=os.path.join(app.instance_path, "logs",
+                                "slow_queries.jsonl")
+    LOG_FORMAT="text"
+    LOG_MAX_BYTES=10*1024*1024
+    LOG_BACKUP_COUNT=10
+    LOG_QUEUE_SIZE=10000
 
 app.config.from_object(DefaultConfig)
 app.config.from_pyfile("config.cfg", silent=True)
@@ -27,40 +87,42 @@ try:
 except OSError:
     pass
 
-class RequestFormatter(logging.Formatter):
-    def format(self, record):
-        if has_request_context():
-            record.url = request.url
-            record.remote_addr = request.remote_addr
-        else:
-            record.url = None
-            record.remote_addr = None
-        return super().format(record)
-
-if not app.config["DEBUG"] or True:
-    try:
-        os.makedirs(os.path.join(app.instance_path, "logs"))
-    except OSError:
-        pass
-    file_handler = logging.handlers.RotatingFileHandler(
-        os.path.join(app.instance_path, "logs", "stickpoll.log"),
-        maxBytes=10240,
-        backupCount=10)
-    file_handler.setFormatter(RequestFormatter(
-        '[%(asctime)s] %(remote_addr)s requested %(url)s\n'
-        '%(levelname)s in %(module)s: %(message)s'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.setLevel(logging.INFO)
-    app.logger.info("Startup")
+logs.init_app(app)
+app.logger.info("Startup")
 
 db.init_app(app)
+cache.init_app(app)
+metrics.init_app(app)
+slowlog.init_app(app)
+hashing.init_app(app)
+mail.init_app(app)
+ingest.init_app(app)
+maintenance.init_app(app)
+migrations.init_app(app)
+polls.init_app(app)
+seed.init_app(app)
+worker.init_app(app, polls.generate_results)
+closer.init_app(app, polls.finalise_poll)
+live.init_app(app, app.extensions["results_worker"].request)
 
 app.register_blueprint(polls.bp)
 app.register_blueprint(search.bp)
 
 @app.route("/")
 def home():
+    # The page only changes when polls are added, closed or deleted, which
+    # clear the cache; the TTL covers changes made by other processes.
+    home_cache = cache.get_cache("home")
+    if "_flashes" in session:
+        # Flashed messages are rendered into the page, so it can't be reused.
+        return render_home()
+    html = home_cache.get("html")
+    if html is cache.MISSING:
+        html = render_home()
+        home_cache.set("html", html)
+    return html
+
+def render_home():
     # Fetch the most recent 20 polls open and closed polls
     open_polls = db_funcs.get_recent_polls(20, True)
     closed_polls = db_funcs.get_recent_polls(20, False)
@@ -75,6 +137,11 @@ def about():
 def page_not_found(e):
     return render_template("404.html"), 404
 
+@app.errorhandler(503)
+def service_unavailable(e):
+    app.logger.warning("Error 503: {0}".format(e.description))
+    return render_template("503.html"), 503, {"Retry-After": "5"}
+
 @app.errorhandler(500)
 def internal_server_error(e):
     app.logger.error("Error 500")
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""Benchmarks for the tally, vote, search and page render hot paths.
+
+Runs offline against a throwaway SQLite database, driving pages through
+the Flask test client, and prints JSON timings so runs on different
+commits can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import click
+
+from app import app
+import db
+import db_funcs
+import polls
+from seed import make_ballots, random_text
+import tally
+
+
+def summarise(name, timings, ops=1):
+    """Return stats for a list of timings in seconds, each of ops ops."""
+    timings = sorted(timings)
+    summary = {
+        "name": name,
+        "unit": "seconds",
+        "iterations": len(timings),
+        "min": timings[0],
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        "max": timings[-1],
+    }
+    if ops > 1:
+        summary["ops_per_iteration"] = ops
+        summary["ops_per_second"] = ops / summary["median"]
+    return summary
+
+
+def measure(name, func, iterations, setup=None, ops=1):
+    """Time func() iterations times, calling setup() untimed before each."""
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return summarise(name, timings, ops)
+
+
+def insert_poll(cursor, rng, n_choices, ballots, is_open=True):
+    """Insert a poll with choices and grouped ballots, bypassing add_poll.
+
+    Args:
+        cursor: Database cursor.
+        rng (random.Random): Source of titles and question text.
+        n_choices (int): Number of choices.
+        ballots (dict of int keyed by int): Votes per packed ballot.
+        is_open (bool): Whether the poll is open.
+
+    Returns:
+        int: Poll id.
+    """
+    close_date = datetime.now() + timedelta(days=1 if is_open else -1)
+    cursor.execute("BEGIN")
+    rows = list(cursor.execute(
+        "INSERT INTO Questions (title, text, open, close_date, "
+        "early_results, token, votes_cast) VALUES (?, ?, ?, ?, 1, '', ?); "
+        "SELECT last_insert_rowid()",
+        (random_text(rng, 4).capitalize(), random_text(rng, 12) + "?",
+         int(is_open), int(close_date.timestamp()), sum(ballots.values()))))
+    poll_id = rows[0][0]
+    cursor.executemany("INSERT INTO Choices (text, question_id, "
+                       "choice_number) VALUES (?, ?, ?)",
+                       [(random_text(rng, 2), poll_id, i)
+                        for i in range(n_choices)])
+    cursor.executemany("INSERT INTO Ballots (ballot, count, question_id) "
+                       "VALUES (?, ?, ?)",
+                       [(ballot, count, poll_id)
+                        for ballot, count in ballots.items()])
+    cursor.execute("COMMIT")
+    return poll_id
+
+
+def tally_distributions(rng, n_ballots):
+    """Return {name: (n_choices, ballots)} for the tally benchmarks."""
+    top = tally.MAX_CHOICES
+    return {
+        # Every choice in play, short rankings.
+        "many_candidates": (top, make_ballots(
+            rng, n_ballots, top, lambda r: r.randint(1, 3))),
+        # Full rankings, so every ballot survives every round.
+        "deep_rankings": (top, make_ballots(
+            rng, n_ballots, top, lambda r: top)),
+        # Near-equal first preferences, eliminating one choice per round.
+        "near_ties": (top, make_ballots(
+            rng, n_ballots, top, lambda r: r.randint(top // 2, top),
+            first=lambda i: i % top)),
+    }
+
+
+def bench_tally(cursor, rng, n_ballots, iterations):
+    results = []
+    backends = ["python"]
+    if tally.numpy is not None:
+        backends.append("numpy")
+    for name, (n_choices, ballots) in tally_distributions(
+            rng, n_ballots).items():
+        poll_id = insert_poll(cursor, rng, n_choices, ballots)
+
+        def reset():
+            # Force a full recount from the database every time.
+            cursor.execute("DELETE FROM Results WHERE question_id = ?",
+                           (poll_id,))
+            tally.discard_tally(poll_id)
+
+        for backend in backends:
+            app.config["TALLY_BACKEND"] = backend
+            results.append(measure(
+                "generate_results.{0}.{1}".format(name, backend),
+                lambda: polls.generate_results(poll_id), iterations,
+                setup=reset))
+    app.config["TALLY_BACKEND"] = "auto"
+    return results
+
+
+def bench_votes(cursor, rng, n_votes, iterations):
+    poll_id = insert_poll(cursor, rng, 6, {})
+    ballots = [tally.pack_ballot(rng.sample(range(6), rng.randint(1, 6)))
+               for _ in range(n_votes)]
+
+    def cast():
+        for ballot in ballots:
+            db_funcs.add_vote(poll_id, ballot)
+
+    return [measure("add_vote", cast, iterations, ops=n_votes)]
+
+
+def bench_search(cursor, rng, sizes, iterations):
+    results = []
+    inserted = 0
+    for size in sorted(sizes):
+        while inserted < size:
+            insert_poll(cursor, rng, 2, {}, is_open=rng.random() < 0.5)
+            inserted += 1
+        db.init_index_db()
+        for term in ("lunch", "best OR worst"):
+            for order_by in ("rel", "close_date"):
+                results.append(measure(
+                    "search_db.{0}.{1}.{2}".format(
+                        size, term.replace(" ", "_"), order_by),
+                    lambda: db_funcs.search_db(term, "all", "both", order_by,
+                                               "desc",
+                                               app.config["SEARCH_PAGE_SIZE"]),
+                    iterations))
+    return results
+
+
+def bench_pages(cursor, rng, iterations):
+    ballots = make_ballots(rng, 1000, 6, lambda r: r.randint(1, 6))
+    poll_id = insert_poll(cursor, rng, 6, ballots)
+    polls.generate_results(poll_id)
+    client = app.test_client()
+    # Visit once so later requests carry a valid session.
+    client.get("/polls/{0}/".format(poll_id))
+    pages = {"home": "/",
+             "poll": "/polls/{0}/".format(poll_id),
+             "results": "/polls/{0}/results".format(poll_id)}
+    results = []
+    for name, url in pages.items():
+
+        def fetch():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+
+        results.append(measure("page.{0}.warm".format(name), fetch,
+                               iterations))
+        results.append(measure("page.{0}.cold".format(name), fetch,
+                               iterations, setup=clear_caches))
+    return results
+
+
+def clear_caches():
+    for page_cache in app.extensions["caches"].values():
+        page_cache.clear()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """Print the change in median time for benchmarks in both runs."""
+    before = {result["name"]: result for result in previous["results"]}
+    for result in current["results"]:
+        if result["name"] in before:
+            ratio = result["median"] / before[result["name"]]["median"]
+            click.echo("{0:50} {1:8.2f}x".format(result["name"], ratio),
+                       err=True)
+
+
+@click.command()
+@click.option("--iterations", type=int, default=10,
+              help="Timed runs per benchmark.")
+@click.option("--ballots", type=int, default=20000,
+              help="Ballots per poll in the tally benchmarks.")
+@click.option("--votes", type=int, default=500,
+              help="Votes cast per add_vote iteration.")
+@click.option("--search-sizes", default="1000,10000",
+              help="Comma-separated poll counts for the search benchmarks.")
+@click.option("--seed", type=int, default=0, help="Random seed.")
+@click.option("--output", type=click.File("w"), default="-",
+              help="Where to write the JSON results.")
+@click.option("--compare", "compare_to", type=click.File("r"), default=None,
+              help="Earlier JSON results to compare against.")
+def main(iterations, ballots, votes, search_sizes, seed, output, compare_to):
+    """Run the benchmarks against a temporary database."""
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp(prefix="stickpoll-bench-")
+    app.config.update(DATABASE=os.path.join(directory, "bench.sqlite"),
+                      TESTING=True, WTF_CSRF_ENABLED=False,
+                      RESULTS_WORKER="external", POLL_CLOSER="external",
+                      MAIL_SENDER="external", MAIL_TRANSPORT="memory",
+                      VOTE_INGEST="direct",
+                      # Only needed to render the captcha widget.
+                      RECAPTCHA_PUBLIC_KEY="benchmark",
+                      RECAPTCHA_PRIVATE_KEY="benchmark")
+    try:
+        with app.app_context():
+            db.init_db()
+            db.init_index_db()
+            cursor = db.get_db(raw=True)
+            results = []
+            results += bench_tally(cursor, rng, ballots, iterations)
+            results += bench_votes(cursor, rng, votes, iterations)
+            results += bench_search(
+                cursor, rng, [int(size) for size in search_sizes.split(",")],
+                iterations)
+            results += bench_pages(cursor, rng, iterations)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    run = {"commit": git_commit(),
+           "timestamp": int(time.time()),
+           "python": platform.python_version(),
+           "numpy": tally.numpy is not None,
+           "parameters": {"iterations": iterations, "ballots": ballots,
+                          "votes": votes, "search_sizes": search_sizes,
+                          "seed": seed},
+           "results": results}
+    json.dump(run, output, indent=2)
+    output.write("\n")
+    if compare_to is not None:
+        compare(json.load(compare_to), run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""In-process caches."""
+
+from collections import OrderedDict
+import threading
+import time
+
+from flask import current_app
+
+# Returned by LRUCache.get when nothing is cached, since None is cacheable.
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with optional expiry.
+
+    Entries are also dropped after ttl seconds, which bounds how stale an
+    entry can get when it's changed by another process.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return cached value for key, or MISSING."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value):
+        """Cache value for key, evicting the least recently used if full."""
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop cached value for key, if any."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Drop every cached value."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries)}
+
+
+def get_cache(name):
+    """Return the named cache for the current app."""
+    return current_app.extensions["caches"][name]
+
+
+def stats():
+    """Return stats for every cache, keyed by cache name."""
+    return {name: c.stats()
+            for name, c in current_app.extensions["caches"].items()}
+
+
+def init_app(app):
+    app.extensions["caches"] = {
+        "polls": LRUCache(app.config["POLL_CACHE_SIZE"],
+                          app.config["POLL_CACHE_TTL"]),
+        "choices": LRUCache(app.config["POLL_CACHE_SIZE"],
+                            app.config["POLL_CACHE_TTL"]),
+        "search": LRUCache(app.config["SEARCH_CACHE_SIZE"],
+                           app.config["SEARCH_CACHE_TTL"]),
+        "home": LRUCache(1, app.config["HOME_CACHE_TTL"]),
+        "results": LRUCache(app.config["POLL_CACHE_SIZE"],
+                            app.config["POLL_CACHE_TTL"]),
+    }
@@ -0,0 +1,158 @@
+"""Scheduled closing of polls.
+
+Upcoming closing dates of open polls are kept in a min-heap. As each comes
+due the poll is finalised: closed, counted once more, and only then are its
+ballots deleted. Nobody waits on a final count in a request; a visitor who
+finds an overdue poll only asks for it to be finalised now.
+
+The closer runs as a thread in the web process (POLL_CLOSER = "thread") or
+as a separate `flask poll-closer` process (POLL_CLOSER = "external"). Either
+way it reloads the heap every CLOSER_RELOAD_INTERVAL seconds to pick up polls
+added by other processes. Several closers can run at once, since only the
+one that actually closes a poll goes on to finalise it.
+"""
+
+import heapq
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import db_funcs
+
+
+class PollCloser:
+    """Min-heap of (close_date, poll_id) for open polls."""
+
+    def __init__(self, app, finalise):
+        """Create closer for app, closing polls with finalise(poll_id)."""
+        self.app = app
+        self.finalise = finalise
+        self.heap = []
+        # IDs of polls in the heap, so none is scheduled twice.
+        self.scheduled = set()
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def load(self):
+        """Rebuild the heap from the open polls in the database."""
+        heap = [(close_date, poll_id) for poll_id, close_date
+                in db_funcs.get_open_polls_closing()]
+        heapq.heapify(heap)
+        with self.condition:
+            self.heap = heap
+            self.scheduled = {poll_id for close_date, poll_id in heap}
+            self.condition.notify()
+
+    def schedule(self, poll_id, close_date):
+        """Arrange for poll to be finalised at close_date.
+
+        Only the in-process closer thread keeps a heap; an external closer
+        finds new polls when it next reloads.
+        """
+        if self.app.config["POLL_CLOSER"] != "thread":
+            return
+        with self.condition:
+            if poll_id not in self.scheduled:
+                self.scheduled.add(poll_id)
+                heapq.heappush(self.heap, (close_date, poll_id))
+            self.condition.notify()
+        self.start()
+
+    def close_soon(self, poll_id):
+        """Finalise an overdue poll as soon as possible.
+
+        A poll already in the heap is overdue there too, so is left as is.
+        """
+        self.schedule(poll_id, 0)
+
+    def pop_due(self):
+        """Remove and return IDs of polls whose closing date has passed."""
+        now = time.time()
+        due = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                poll_id = heapq.heappop(self.heap)[1]
+                self.scheduled.discard(poll_id)
+                due.append(poll_id)
+        return due
+
+    def run_one(self, poll_id):
+        """Finalise a single poll inside an app context."""
+        try:
+            with self.app.app_context():
+                self.finalise(poll_id)
+        except Exception:
+            self.app.logger.exception("Closing failed for poll {0}"
+                                      .format(poll_id))
+
+    def run_due(self):
+        """Finalise every poll that's due."""
+        for poll_id in self.pop_due():
+            self.run_one(poll_id)
+
+    def wait(self, timeout):
+        """Sleep until the next closing date, a new poll, or timeout."""
+        with self.condition:
+            if self.heap:
+                timeout = min(timeout, max(self.heap[0][0] - time.time(), 0))
+            self.condition.wait(timeout)
+
+    def run(self):
+        """Finalise polls as they come due, forever."""
+        reload_interval = self.app.config["CLOSER_RELOAD_INTERVAL"]
+        while True:
+            with self.app.app_context():
+                self.load()
+            reload_at = time.monotonic() + reload_interval
+            while time.monotonic() < reload_at:
+                self.run_due()
+                self.wait(reload_at - time.monotonic())
+
+    def start(self):
+        """Start the in-process closer thread, if not already running."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name="poll-closer",
+                                           daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                self.app.logger.exception("Poll closer failed")
+                time.sleep(self.app.config["CLOSER_RELOAD_INTERVAL"])
+
+
+def get_closer():
+    """Return the poll closer for the current app."""
+    return current_app.extensions["poll_closer"]
+
+
+@click.command("poll-closer")
+@click.option("--once", is_flag=True,
+              help="Finalise polls that are already due and exit.")
+@with_appcontext
+def poll_closer_command(once):
+    """Finalise polls as their closing dates pass."""
+    poll_closer = get_closer()
+    if once:
+        poll_closer.load()
+        poll_closer.run_due()
+    else:
+        poll_closer.run()
+
+
+def init_app(app, finalise):
+    poll_closer = PollCloser(app, finalise)
+    app.extensions["poll_closer"] = poll_closer
+    app.cli.add_command(poll_closer_command)
+    if app.config["POLL_CLOSER"] == "thread":
+        app.before_first_request(poll_closer.start)
@@ -1,28 +1,198 @@
 #!/usr/bin/env python3
 
+import os
+import queue
+import threading
+import time
+
 import apsw
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
-def get_db():
-    """Get cursor from database connection, opening a new one if necessary."""
-    def row_factory(cursor, row):
-        return {k[0]: row[i] for i, k in enumerate(cursor.getdescription())}
+class ConnectionPool:
+    """Idle database connections for reuse by later requests.
+
+    Connections are configured once when opened (see open_connection) and
+    keep their prepared statement cache between requests.
+    """
+
+    def __init__(self, config, query_observers=None):
+        self.config = config
+        # Called with each statement's run time; see instrument.
+        self.query_observers = query_observers
+        self.idle = queue.LifoQueue(maxsize=config["DB_POOL_SIZE"])
+
+    def open_connection(self):
+        """Open and configure a new connection."""
+        conn = apsw.Connection(
+            self.config["DATABASE"],
+            statementcachesize=self.config["DB_STATEMENT_CACHE_SIZE"])
+        # Wait for other writers (e.g. the results worker) rather than fail.
+        conn.setbusytimeout(self.config["DB_BUSY_TIMEOUT"])
+        if self.query_observers:
+            instrument(conn, self.query_observers)
+        cur = conn.cursor()
+        cur.execute("PRAGMA foreign_keys = ON")
+        # Only takes effect on a new database file; `flask maintain-db
+        # --vacuum` converts older ones.
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        list(cur.execute("PRAGMA journal_mode = {0}"
+                         .format(self.config["DB_JOURNAL_MODE"])))
+        cur.execute("PRAGMA synchronous = {0}"
+                    .format(self.config["DB_SYNCHRONOUS"]))
+        cur.execute("PRAGMA cache_size = {0:d}"
+                    .format(self.config["DB_CACHE_SIZE"]))
+        list(cur.execute("PRAGMA mmap_size = {0:d}"
+                         .format(self.config["DB_MMAP_SIZE"])))
+        return conn
+
+    def checkout(self):
+        """Return an idle connection, or a new one if none are idle."""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.open_connection()
+
+    def checkin(self, conn):
+        """Return a connection to the pool, closing it if the pool is full."""
+        if not conn.getautocommit():
+            # A request failed mid-transaction; don't hand that on.
+            conn.cursor().execute("ROLLBACK")
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def instrument(conn, observers):
+    """Time every statement run on an apsw connection.
+
+    The exec trace notes when each statement starts and the profile hook,
+    called as it completes, passes (statement, bindings, seconds) to each
+    observer. SQLite's own profile timings are only to the millisecond.
+    """
+    started = [None, None, None]
+
+    def exec_trace(cursor, statement, bindings):
+        started[:] = [statement.strip(), bindings, time.perf_counter()]
+        return True
+
+    def profile(statement, nanoseconds):
+        # SQLite also profiles statements run internally, e.g. by FTS5,
+        # which would otherwise be timed from the outer statement's start.
+        if statement.strip() != started[0]:
+            return
+        statement, bindings, start = started
+        seconds = time.perf_counter() - start
+        started[:] = [None, None, None]
+        for observer in observers:
+            observer(statement, bindings, seconds)
+
+    conn.setexectrace(exec_trace)
+    conn.setprofile(profile)
+
+# Pools by (process id, database path), so forked workers never share
+# connections opened by their parent.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool():
+    """Return the connection pool for this process and database."""
+    key = (os.getpid(), current_app.config["DATABASE"])
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(
+                current_app.config,
+                current_app.extensions.get("query_observers"))
+    return pool
+
+class Row:
+    """Database row readable by column name, like a read-only dict.
+
+    Values stay in the tuple apsw returned; the column name lookup is shared
+    by every row from the same statement.
+    """
+
+    __slots__ = ("_values", "_columns")
+
+    def __init__(self, values, columns):
+        self._values = values
+        self._columns = columns
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._columns[key]]
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __repr__(self):
+        return "Row({0!r})".format(dict(self.items()))
+
+    def get(self, key, default=None):
+        if key in self._columns:
+            return self._values[self._columns[key]]
+        return default
+
+    def keys(self):
+        return self._columns.keys()
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return [(k, self._values[i]) for k, i in self._columns.items()]
+
+# Column name lookups keyed by apsw's description tuple. apsw builds a new,
+# equal tuple each time a statement runs, but returns the same one for every
+# row of a run, so the last one used is checked by identity first rather
+# than hashing it again for every row.
+_columns_cache = {}
+_last_columns = (None, None)
+MAX_CACHED_DESCRIPTIONS = 1000
+
+def row_factory(cursor, row):
+    """Row trace turning apsw's tuples into Rows."""
+    global _last_columns
+    description = cursor.getdescription()
+    last_description, columns = _last_columns
+    if last_description is not description:
+        columns = _columns_cache.get(description)
+        if columns is None:
+            if len(_columns_cache) >= MAX_CACHED_DESCRIPTIONS:
+                _columns_cache.clear()
+            columns = {k[0]: i for i, k in enumerate(description)}
+            _columns_cache[description] = columns
+        _last_columns = (description, columns)
+    return Row(row, columns)
+
+def get_db(raw=False):
+    """Get cursor from database connection, checking one out if necessary.
+
+    Rows come back as Rows unless raw is set, in which case they're plain
+    tuples in column order.
+    """
     if "db" not in g:
-        g.db = apsw.Connection(
-            current_app.config["DATABASE"]
-            )
-        g.db.setrowtrace(row_factory)
-        g.db.cursor().execute("PRAGMA foreign_keys = ON")
-    return g.db.cursor()
+        g.db = get_pool().checkout()
+    cursor = g.db.cursor()
+    if not raw:
+        cursor.setrowtrace(row_factory)
+    return cursor
 
 def close_db(e=None):
-    """Close database connection, if open."""
+    """Return database connection to the pool, if checked out."""
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        get_pool().checkin(db)
 
 def init_db():
     """Execute main database schema."""
@@ -38,10 +208,12 @@ def init_index_db():
     db.execute("INSERT INTO Questions_index "
                "(rowid, title, text, open, close_date) "
                "SELECT id, title, text, open, close_date FROM Questions")
+    # Searches cached before the rebuild may no longer match the index.
+    db.execute("UPDATE SearchGeneration SET generation = generation + 1")
 
-def query_db(query, args=(), one=False):
+def query_db(query, args=(), one=False, raw=False):
     """Run query against database, returning list() results from cursor."""
-    cur = get_db().execute(query, args)
+    cur = get_db(raw).execute(query, args)
     rv = list(cur)
     cur.close()
     return (rv[0] if rv else None) if one else rv
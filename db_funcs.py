@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import cache
 from db import get_db, query_db
+import hashing
+import tally
 import utils
 
 from datetime import datetime
@@ -25,7 +28,7 @@ def add_poll(title, question, choices, close_date, early_results, password,
 ##    salt = hashlib.sha1(title.encode("utf-8")
 ##                        + str(close_date).encode("utf-8")).digest()
     salt = utils.get_poll_salt(title, close_date)
-    token = utils.hash_password(password, salt)
+    token = hashing.hash_password(password, salt)
     statement = ("BEGIN; INSERT INTO Questions (title, text, open, "
                  "close_date, early_results, token, email) "
                  "VALUES (?, ?, ?, ?, ?, ?, ?); "
@@ -39,6 +42,7 @@ def add_poll(title, question, choices, close_date, early_results, password,
                  "VALUES (?, ?, ?)")
     db.executemany(statement, [(choice, poll_id, i)
                                for i, choice in enumerate(choices)])
+    cache.get_cache("home").clear()
     return poll_id
 
 def get_cookie_hash(cookie_id):
@@ -50,38 +54,145 @@ def get_cookie_hash(cookie_id):
     else:
         return None
 
+def get_cookie(cookie_id):
+    """Return hash, generation and last_seen for given cookie id, or None."""
+    statement = "SELECT hash, generation, last_seen FROM Cookies WHERE id = ?"
+    return query_db(statement, (cookie_id,), one=True)
+
 def new_cookie():
-    """Insert new blank cookie record and return id."""
+    """Insert new blank cookie record, seen now, and return id."""
     statement = ("BEGIN; INSERT INTO Cookies (hash, last_seen) VALUES (?, ?); "
                  "SELECT last_insert_rowid(); COMMIT")
     db = get_db()
-    c = db.execute(statement, ("", 0))
+    c = db.execute(statement, ("", int(datetime.now().timestamp())))
     row = list(c)[0]
     cookie_id = row["last_insert_rowid()"]
     return cookie_id
 
 def get_poll(poll_id):
-    """Return database record of given poll question id."""
-    statement = "SELECT * FROM Questions WHERE id = ?"
-    return query_db(statement, (poll_id,), one=True)
+    """Return database record of given poll question id.
+
+    Records are cached, so this leaves out votes_cast, which changes with
+    every vote; use get_number_votes_cast for that.
+    """
+    poll_cache = cache.get_cache("polls")
+    row = poll_cache.get(poll_id)
+    if row is cache.MISSING:
+        statement = ("SELECT id, title, text, open, close_date, early_results, "
+                     "email, token FROM Questions WHERE id = ?")
+        row = query_db(statement, (poll_id,), one=True)
+        if row is not None:
+            poll_cache.set(poll_id, row)
+    return row
 
 def get_choices(poll_id):
-    """Return database records of choices for given poll question id."""
-    statement = "SELECT * FROM Choices WHERE question_id = ?"
-    return query_db(statement, (poll_id,))
-
-def add_vote(poll_id, ballot_string):
-    """Add one vote for given poll question id and ballot string."""
-    statement = ("BEGIN; UPDATE Ballots SET count = count + 1 WHERE "
-                 "question_id = ? AND ballot_string = ?; SELECT changes(); "
-                 "COMMIT")
-    db = get_db()
-    c = db.execute(statement, (poll_id, ballot_string))
-    row = list(c)[0]
-    if row["changes()"] == 0:
-        statement = ("INSERT INTO Ballots (ballot_string, question_id, count) "
-                     "VALUES (?, ?, ?)")
-        db.execute(statement, (ballot_string, poll_id, 1))
+    """Return choices for given poll question id.
+
+    Returns:
+        (list of tuple): (choice_number, text) for each choice, in order.
+    """
+    choice_cache = cache.get_cache("choices")
+    choices = choice_cache.get(poll_id)
+    if choices is cache.MISSING:
+        statement = ("SELECT choice_number, text FROM Choices "
+                     "WHERE question_id = ? ORDER BY choice_number")
+        choices = query_db(statement, (poll_id,), raw=True)
+        if choices:
+            choice_cache.set(poll_id, choices)
+    return choices
+
+def rollback(db):
+    """Roll back the transaction on db's connection, if one is open.
+
+    A failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction open, but
+    other failures may have ended it already.
+    """
+    if not db.getconnection().getautocommit():
+        db.execute("ROLLBACK")
+
+def add_vote(poll_id, ballot):
+    """Add one vote for given poll question id and packed ballot.
+
+    Also bumps the poll's votes_cast counter, which doubles as the version
+    of its ballots for deciding whether results need recounting.
+    """
+    db = get_db(raw=True)
+    db.execute("BEGIN")
+    try:
+        versions = list(db.execute(
+            "UPDATE Questions SET votes_cast = votes_cast + 1 "
+            "WHERE id = ? RETURNING votes_cast", (poll_id,)))
+        db.execute("INSERT INTO Ballots (ballot, question_id, count) "
+                   "VALUES (?, ?, 1) ON CONFLICT (question_id, ballot) "
+                   "DO UPDATE SET count = count + 1", (ballot, poll_id))
+        db.execute("COMMIT")
+    except Exception:
+        rollback(db)
+        raise
+    for (version,) in versions:
+        tally.record_votes(poll_id, {ballot: 1}, version)
+
+def add_votes(votes):
+    """Add a batch of votes and voters' cookie updates in one transaction.
+
+    Args:
+        votes (list of tuple): (poll_id, ballot, cookie_id, cookie_hash,
+            generation, last_seen) for each vote. With a cookie_hash the
+            cookie record just gets the new hash, as update_cookie does;
+            otherwise its generation is advanced as rotate_cookie does, and
+            the vote is rejected if the cookie wasn't at that generation.
+
+    Returns:
+        (list of bool): Whether each vote was accepted, or None for a vote
+            whose poll no longer exists, e.g. deleted by another process
+            since it was cached. Neither touches the voter's cookie.
+    """
+    db = get_db(raw=True)
+    # Taking the write lock up front keeps the polls found below current.
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        poll_ids = list({vote[0] for vote in votes})
+        existing = {row[0] for row in db.execute(
+            "SELECT id FROM Questions WHERE id IN ({0})"
+            .format(", ".join("?" * len(poll_ids))), poll_ids)}
+        accepted = []
+        ballot_counts = {}
+        for (poll_id, ballot, cookie_id, cookie_hash, generation,
+             last_seen) in votes:
+            if poll_id not in existing:
+                accepted.append(None)
+                continue
+            if cookie_hash is not None:
+                update_cookie(cookie_id, cookie_hash, last_seen)
+            elif not rotate_cookie(cookie_id, generation, last_seen):
+                accepted.append(False)
+                continue
+            accepted.append(True)
+            # Merge identical ballots into one row update.
+            key = (poll_id, ballot)
+            ballot_counts[key] = ballot_counts.get(key, 0) + 1
+        poll_counts = {}
+        for (poll_id, ballot), count in ballot_counts.items():
+            poll_counts[poll_id] = poll_counts.get(poll_id, 0) + count
+        versions = dict(db.executemany(
+            "UPDATE Questions SET votes_cast = votes_cast + ? "
+            "WHERE id = ? RETURNING id, votes_cast",
+            [(count, poll_id) for poll_id, count in poll_counts.items()]))
+        db.executemany("INSERT INTO Ballots (ballot, question_id, count) "
+                       "VALUES (?, ?, ?) ON CONFLICT (question_id, ballot) "
+                       "DO UPDATE SET count = count + excluded.count",
+                       [(ballot, poll_id, count) for (poll_id, ballot), count
+                        in ballot_counts.items()])
+        db.execute("COMMIT")
+    except Exception:
+        rollback(db)
+        raise
+    poll_ballots = {}
+    for (poll_id, ballot), count in ballot_counts.items():
+        poll_ballots.setdefault(poll_id, {})[ballot] = count
+    for poll_id, version in versions.items():
+        tally.record_votes(poll_id, poll_ballots[poll_id], version)
+    return accepted
 
 def update_cookie(cookie_id, cookie_hash, last_seen):
     """Update cookie record.
@@ -93,33 +204,89 @@ def update_cookie(cookie_id, cookie_hash, last_seen):
     db = get_db()
     db.execute(statement, (cookie_hash, last_seen, cookie_id))
 
+def touch_cookie(cookie_id, last_seen):
+    """Update last seen timestamp for given cookie id."""
+    statement = "UPDATE Cookies SET last_seen = ? WHERE id = ?"
+    db = get_db()
+    db.execute(statement, (last_seen, cookie_id))
+
+def rotate_cookie(cookie_id, generation, last_seen):
+    """Advance cookie record's generation, if it's still at generation.
+
+    Returns:
+        bool: False if the cookie is missing or already moved on, meaning
+            the session presenting it is stale or replayed.
+    """
+    statement = ("UPDATE Cookies SET generation = generation + 1, "
+                 "last_seen = ? WHERE id = ? AND generation = ?; "
+                 "SELECT changes()")
+    row = query_db(statement, (last_seen, cookie_id, generation), one=True,
+                   raw=True)
+    return row[0] == 1
+
 def get_ballots(poll_id):
     """Return votes for given poll question id.
 
     Returns:
-        (dict of int keyed by str): Number of votes for each ballot string
-            keyed by the ballot strings.
+        (dict of int keyed by int): Number of votes for each packed ballot
+            (see tally.pack_ballot) keyed by the packed ballots.
     """
-    statement = "SELECT ballot_string, count FROM Ballots WHERE question_id = ?"
-    rows = query_db(statement, (poll_id,))
-    ballots = {row["ballot_string"]: row["count"] for row in rows}
+    statement = "SELECT ballot, count FROM Ballots WHERE question_id = ?"
+    rows = query_db(statement, (poll_id,), raw=True)
+    ballots = {ballot: count for ballot, count in rows}
     return ballots
 
-def update_results(poll_id, results_json):
-    """Update stored results json for given poll question id."""
-    statement = ("BEGIN; UPDATE Results SET results_json = ?, last_update = ? "
-                 "WHERE question_id = ?; SELECT changes(); COMMIT")
+def get_versioned_ballots(poll_id):
+    """Return a poll's votes_cast and ballots, read in one transaction.
+
+    Returns:
+        (tuple): votes_cast, and votes per packed ballot as returned by
+            get_ballots; None if there's no such poll.
+    """
     db = get_db()
-    c = db.execute(statement, (results_json,
-                               int(datetime.now().timestamp()),
-                               poll_id))
-    row = list(c)[0]
-    if row["changes()"] == 0:
-        statement = ("INSERT INTO Results (results_json, last_update, "
-                     "question_id)  VALUES (?, ?, ?)")
-        db.execute(statement, (results_json,
-                               int(datetime.now().timestamp()),
-                               poll_id))
+    db.execute("BEGIN")
+    try:
+        row = query_db("SELECT votes_cast FROM Questions WHERE id = ?",
+                       (poll_id,), one=True, raw=True)
+        ballots = get_ballots(poll_id)
+        db.execute("COMMIT")
+    except Exception:
+        rollback(db)
+        raise
+    if row is None:
+        return None
+    return row[0], ballots
+
+def update_results(poll_id, results_json, votes_cast, final=False):
+    """Update stored results json for given poll question id.
+
+    Final results are never updated again.
+
+    Args:
+        poll_id (int): Poll question id.
+        results_json (str): Serialised round-by-round results.
+        votes_cast (int): The poll's votes_cast when the ballots were read.
+        final (bool): Whether these are the closed poll's final results.
+    """
+    statement = ("INSERT INTO Results (results_json, last_update, "
+                 "votes_cast, final, question_id) VALUES (?, ?, ?, ?, ?) "
+                 "ON CONFLICT (question_id) DO UPDATE SET "
+                 "results_json = excluded.results_json, "
+                 "last_update = excluded.last_update, "
+                 "votes_cast = excluded.votes_cast, "
+                 "final = excluded.final WHERE Results.final = 0")
+    db = get_db()
+    db.execute(statement, (results_json,
+                           int(datetime.now().timestamp()),
+                           votes_cast,
+                           int(final),
+                           poll_id))
+
+def freeze_results(poll_id):
+    """Mark stored results for given poll question id as final."""
+    statement = "UPDATE Results SET final = 1 WHERE question_id = ?"
+    db = get_db()
+    db.execute(statement, (poll_id,))
 
 def get_results(poll_id):
     """Return results json for given poll question id."""
@@ -127,42 +294,204 @@ def get_results(poll_id):
     return query_db(statement, (poll_id,), one=True)
 
 def close_poll(poll_id):
-    """Close poll, delete associated ballots."""
-    statement = "UPDATE Questions SET open = 0 WHERE id = ?"
+    """Close poll. Return False if it was already closed.
+
+    Ballots are kept for the final count; see delete_counted_ballots.
+    """
+    statement = ("UPDATE Questions SET open = 0 WHERE id = ? AND open = 1; "
+                 "SELECT changes()")
+    row = query_db(statement, (poll_id,), one=True, raw=True)
+    cache.get_cache("polls").invalidate(poll_id)
+    cache.get_cache("home").clear()
+    return row[0] == 1
+
+def delete_counted_ballots(poll_id):
+    """Delete ballots of a closed poll, if its stored results count them all.
+    """
+    statement = ("DELETE FROM Ballots WHERE question_id = ? AND EXISTS "
+                 "(SELECT 1 FROM Questions JOIN Results "
+                 "ON Results.question_id = Questions.id "
+                 "WHERE Questions.id = ? AND Questions.open = 0 "
+                 "AND Results.votes_cast = Questions.votes_cast)")
     db = get_db()
-    db.execute(statement, (poll_id,))
-    statement = "DELETE FROM Ballots WHERE question_id = ?"
-    db.execute(statement, (poll_id,))
+    db.execute(statement, (poll_id, poll_id))
+    tally.discard_tally(poll_id)
 
 def close_expired_polls():
     """Close polls whose closing date has passed. Return IDs of closed polls."""
     statement = ("SELECT id FROM Questions WHERE open = 1 "
-                 "AND close_date >= ?")
-    rows = query_db(statement, (datetime.now().timestamp(),))
+                 "AND close_date <= ?")
+    rows = query_db(statement, (int(datetime.now().timestamp()),))
     close_ids = [row["id"] for row in rows]
     db = get_db()
     statement = "UPDATE Questions SET open = 0 WHERE id = ?"
-    db.executemany(statement, close_ids)
+    db.executemany(statement, [(poll_id,) for poll_id in close_ids])
+    for poll_id in close_ids:
+        cache.get_cache("polls").invalidate(poll_id)
+    cache.get_cache("home").clear()
     return close_ids
 
+def delete_stale_cookies(last_seen, limit):
+    """Delete up to limit cookies not seen since last_seen. Return count."""
+    statement = ("DELETE FROM Cookies WHERE id IN (SELECT id FROM Cookies "
+                 "WHERE last_seen IS NULL OR last_seen < ? LIMIT ?); "
+                 "SELECT changes()")
+    row = query_db(statement, (last_seen, limit), one=True, raw=True)
+    return row[0]
+
+def delete_finalised_ballots(limit):
+    """Delete up to limit ballots no longer needed. Return count.
+
+    That's ballots of closed polls whose stored results already count every
+    vote, and ballots of polls which no longer exist.
+    """
+    statement = ("DELETE FROM Ballots WHERE id IN (SELECT Ballots.id "
+                 "FROM Ballots LEFT JOIN Questions "
+                 "ON Questions.id = Ballots.question_id "
+                 "LEFT JOIN Results ON Results.question_id = Questions.id "
+                 "WHERE Questions.id IS NULL OR (Questions.open = 0 "
+                 "AND Results.votes_cast = Questions.votes_cast) LIMIT ?); "
+                 "SELECT changes()")
+    row = query_db(statement, (limit,), one=True, raw=True)
+    return row[0]
+
+def delete_orphaned_results(limit):
+    """Delete up to limit results of polls which no longer exist."""
+    statement = ("DELETE FROM Results WHERE id IN (SELECT Results.id "
+                 "FROM Results LEFT JOIN Questions "
+                 "ON Questions.id = Results.question_id "
+                 "WHERE Questions.id IS NULL LIMIT ?); SELECT changes()")
+    row = query_db(statement, (limit,), one=True, raw=True)
+    return row[0]
+
+def queue_email(sender, recipient, subject, html):
+    """Add an email to the outbox and return its id."""
+    statement = ("BEGIN; INSERT INTO Outbox (sender, recipient, subject, "
+                 "html, created, next_attempt) VALUES (?, ?, ?, ?, ?, ?); "
+                 "SELECT last_insert_rowid(); COMMIT")
+    now = int(datetime.now().timestamp())
+    row = query_db(statement, (sender, recipient, subject, html, now, now),
+                   one=True, raw=True)
+    return row[0]
+
+def claim_emails(claim, limit, max_attempts, claim_until):
+    """Claim up to limit unsent emails that are due, and return them.
+
+    Claimed emails aren't due again until claim_until, so another sender
+    won't pick them up meanwhile.
+
+    Args:
+        claim (str): Random token identifying this claim.
+        limit (int): Maximum number of emails to claim.
+        max_attempts (int): Emails already tried this often are given up.
+        claim_until (int): Timestamp when unsent claimed emails are due.
+    """
+    statement = ("UPDATE Outbox SET claim = ?, next_attempt = ? "
+                 "WHERE id IN (SELECT id FROM Outbox WHERE sent IS NULL "
+                 "AND attempts < ? AND next_attempt <= ? "
+                 "ORDER BY next_attempt LIMIT ?)")
+    db = get_db()
+    db.execute(statement, (claim, claim_until, max_attempts,
+                           int(datetime.now().timestamp()), limit))
+    statement = ("SELECT id, sender, recipient, subject, html, attempts "
+                 "FROM Outbox WHERE claim = ? AND sent IS NULL")
+    return query_db(statement, (claim,))
+
+def mark_email_sent(email_id):
+    """Record that an email from the outbox was sent."""
+    statement = "UPDATE Outbox SET sent = ?, claim = NULL WHERE id = ?"
+    db = get_db()
+    db.execute(statement, (int(datetime.now().timestamp()), email_id))
+
+def mark_email_failed(email_id, next_attempt, error):
+    """Record a failed attempt to send an email, and when to try again."""
+    statement = ("UPDATE Outbox SET attempts = attempts + 1, "
+                 "next_attempt = ?, last_error = ?, claim = NULL WHERE id = ?")
+    db = get_db()
+    db.execute(statement, (next_attempt, error, email_id))
+
+def delete_sent_emails(sent_before, limit):
+    """Delete up to limit emails sent before sent_before. Return count."""
+    statement = ("DELETE FROM Outbox WHERE id IN (SELECT id FROM Outbox "
+                 "WHERE sent < ? LIMIT ?); SELECT changes()")
+    row = query_db(statement, (sent_before, limit), one=True, raw=True)
+    return row[0]
+
 def get_open_polls():
     """Return IDs of open polls."""
     statement = "SELECT id FROM Questions WHERE open = 1"
     return query_db(statement)
 
+def get_open_polls_closing():
+    """Return IDs and closing dates of open polls."""
+    statement = "SELECT id, close_date FROM Questions WHERE open = 1"
+    return query_db(statement, raw=True)
+
 def get_open_early_results_polls():
     """Return IDs of open early_results polls."""
     statement = "SELECT id FROM Questions WHERE open = 1 and early_results = 1"
     return query_db(statement)
 
+def get_stale_early_results_polls():
+    """Return IDs of open early_results polls with votes not yet counted."""
+    statement = ("SELECT Questions.id AS id FROM Questions LEFT JOIN Results "
+                 "ON Results.question_id = Questions.id "
+                 "WHERE Questions.open = 1 AND Questions.early_results = 1 "
+                 "AND (Results.votes_cast IS NULL "
+                 "OR Results.votes_cast != Questions.votes_cast)")
+    return query_db(statement)
+
+def get_unfinalised_closed_polls():
+    """Return IDs of closed polls whose results aren't yet final."""
+    statement = ("SELECT Questions.id AS id FROM Questions LEFT JOIN Results "
+                 "ON Results.question_id = Questions.id "
+                 "WHERE Questions.open = 0 "
+                 "AND (Results.final IS NULL OR Results.final = 0)")
+    return query_db(statement)
+
+def get_live_results(poll_ids):
+    """Return stored results and current votes_cast for several polls.
+
+    Returns:
+        (list of Row): id, open, early_results, votes_cast,
+            results_votes_cast, last_update, final and results_json, the
+            last four None for polls not yet counted.
+    """
+    statement = ("SELECT Questions.id AS id, Questions.open AS open, "
+                 "Questions.early_results AS early_results, "
+                 "Questions.votes_cast AS votes_cast, "
+                 "Results.votes_cast AS results_votes_cast, "
+                 "Results.last_update AS last_update, "
+                 "Results.final AS final, "
+                 "Results.results_json AS results_json "
+                 "FROM Questions LEFT JOIN Results "
+                 "ON Results.question_id = Questions.id "
+                 "WHERE Questions.id IN ({0})"
+                 .format(", ".join("?" * len(poll_ids))))
+    return query_db(statement, poll_ids)
+
 def delete_poll(poll_id):
     """Delete all records related to given poll question id from database."""
     statement = "DELETE FROM Questions WHERE id = ?"
     db = get_db()
     db.execute(statement, (poll_id,))
+    forget_poll(poll_id)
+
+def forget_poll(poll_id):
+    """Drop everything this process holds in memory about a deleted poll."""
+    tally.discard_tally(poll_id)
+    cache.get_cache("polls").invalidate(poll_id)
+    cache.get_cache("home").clear()
+    cache.get_cache("choices").invalidate(poll_id)
+    cache.get_cache("results").invalidate(poll_id)
+
+def search_db(search_string, search_open, search_columns, order_by, order_dir,
+              page_size, after=None):
+    """Search poll question database for some text, one page at a time.
 
-def search_db(search_string, search_open, search_columns, order_by, order_dir):
-    """Search poll question database for some text.
+    Pages are fetched by keyset: each page carries on from the (sort key,
+    id) of the last row of the previous one, so deep pages cost no more
+    than the first.
 
     Args:
         search_string (str): The text to search for.
@@ -172,35 +501,63 @@ def search_db(search_string, search_open, search_columns, order_by, order_dir):
             or both (title/text/both).
         order_by (str): Order by relevance or closing date (rel/close_date).
         order_dir (str): Ascending or descending order (asc/desc).
+        page_size (int): Maximum number of records to return.
+        after (tuple): (sort_key, rowid) of the last record of the previous
+            page, or None for the first page.
 
     Returns:
-        (list of dict): Records from index database matching the query.
+        (list of dict, tuple): Records from index database matching the
+            query, each with its poll's vote count, and the after value for
+            the next page (None if this is the last page).
     """
-    snippet = "snippet(Questions_index, -1, '<b>', '</b>', '...', 10)"
-    statement = ("SELECT rowid, title, open, close_date, {0} AS snippet "
-                 "FROM Questions_index WHERE Questions_index MATCH ? "
-                 ).format(snippet)
-    if search_open == "open":
-        statement += "AND open = 1 "
-    elif search_open == "closed":
-        statement += "AND open = 0 "
-    statement += "ORDER BY "
     if order_by == "rel":
-        statement += "bm25(Questions_index) "
-    else:
-        statement += "close_date "
-    if order_dir == "desc":
-        statement += "DESC, "
+        sort_key = "bm25(Questions_index)"
     else:
-        statement += "ASC, "
-    statement += "title DESC; "
+        sort_key = "Questions_index.close_date"
+    snippet = "snippet(Questions_index, -1, '<b>', '</b>', '...', 10)"
+    statement = ("SELECT Questions_index.rowid AS rowid, "
+                 "Questions_index.title AS title, "
+                 "Questions_index.open AS open, "
+                 "Questions_index.close_date AS close_date, "
+                 "{0} AS snippet, {1} AS sort_key, "
+                 "Questions.votes_cast AS votes "
+                 "FROM Questions_index JOIN Questions "
+                 "ON Questions.id = Questions_index.rowid "
+                 "WHERE Questions_index MATCH ? "
+                 ).format(snippet, sort_key)
     if search_columns == "both":
-        query = ("title:{0} OR text:{0}".format(search_string),)
+        args = ["title:{0} OR text:{0}".format(search_string)]
     elif search_columns == "title":
-        query = ("title:{0}".format(search_string),)
+        args = ["title:{0}".format(search_string)]
     else:
-        query = ("text:{0}".format(search_string),)
-    return query_db(statement, query)
+        args = ["text:{0}".format(search_string)]
+    if search_open == "open":
+        statement += "AND Questions.open = 1 "
+    elif search_open == "closed":
+        statement += "AND Questions.open = 0 "
+    if order_dir == "desc":
+        direction, comparison = "DESC", "<"
+    else:
+        direction, comparison = "ASC", ">"
+    if after is not None:
+        statement += ("AND ({0} {1} ? OR ({0} = ? AND Questions_index.rowid "
+                      "{1} ?)) ").format(sort_key, comparison)
+        args += [after[0], after[0], after[1]]
+    statement += ("ORDER BY {0} {1}, Questions_index.rowid {1} LIMIT ?"
+                  ).format(sort_key, direction)
+    # Fetch one extra row to find out whether there's another page.
+    args.append(page_size + 1)
+    rows = query_db(statement, args)
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        return rows, (last["sort_key"], last["rowid"])
+    return rows, None
+
+def get_search_generation():
+    """Return counter bumped whenever the search index changes."""
+    statement = "SELECT generation FROM SearchGeneration"
+    return query_db(statement, one=True, raw=True)[0]
 
 def get_recent_polls(number_polls, open_polls):
     """Fetch n most recent open/closed polls."""
@@ -208,11 +565,16 @@ def get_recent_polls(number_polls, open_polls):
                  "ORDER BY id DESC LIMIT ?")
     return query_db(statement, (int(open_polls), number_polls))
 
+def get_poll_status(poll_id):
+    """Return current open flag and votes_cast for a poll, bypassing cache."""
+    statement = "SELECT open, votes_cast FROM Questions WHERE id = ?"
+    return query_db(statement, (poll_id,), one=True)
+
 def get_number_votes_cast(poll_id):
     """Count the number of votes cast for a given poll."""
-    statement = "SELECT SUM(count) AS count FROM Ballots WHERE question_id = ?"
-    count = query_db(statement, (poll_id,), one=True)["count"]
-    if count is None:
+    statement = "SELECT votes_cast FROM Questions WHERE id = ?"
+    row = query_db(statement, (poll_id,), one=True)
+    if row is None:
         return 0
     else:
-        return count
+        return row["votes_cast"]
@@ -3,7 +3,8 @@
 from copy import copy
 
 from flask_wtf import FlaskForm, RecaptchaField
-from wtforms import (StringField, PasswordField, BooleanField, FieldList)
+from wtforms import (StringField, PasswordField, BooleanField, FieldList,
+                     HiddenField)
 from wtforms.validators import Email, EqualTo, InputRequired, Length, Optional
 
 from wtforms.widgets.core import HTMLString, RadioInput
@@ -117,6 +118,7 @@ class SearchForm(FlaskForm):
                                               ("asc", "Ascending")],
                                      default="desc",
                                      tags=["li"])
+    cursor = HiddenField()
 
 class VoteForm(FlaskForm):
     """Form class for hidden/noscript ballot_json field in poll page."""
@@ -0,0 +1,188 @@
+"""Poll password hashing, run off the request thread in a process pool.
+
+scrypt is deliberately expensive, so hashes are computed by a pool of
+HASH_WORKERS processes. At most HASH_QUEUE_LIMIT hashes may be running or
+waiting at once; beyond that requests are turned away with a 503 rather
+than queueing up behind each other. HASH_WORKERS = 0 hashes in the request
+thread instead, still subject to the queue limit.
+
+Stored hashes record their own scrypt cost parameters, as
+"scrypt$<n>$<r>$<p>$<hex digest>", so HASH_SCRYPT_N/R/P can be retuned
+without invalidating existing polls. Bare hex digests from before this
+format are checked with the original parameters.
+"""
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import hmac
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.exceptions import ServiceUnavailable
+
+import utils
+
+# Parameters of hashes stored before they recorded their own.
+LEGACY_PARAMS = (2**15, 8, 1)
+
+
+class HashingOverloaded(ServiceUnavailable):
+    """Too many password hashes are already in progress."""
+
+    description = "The server is busy, please try again in a moment."
+
+
+class HashExecutor:
+    """Process pool for password hashes, with a bound on pending work."""
+
+    def __init__(self, workers, queue_limit, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_limit)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+
+    def get_pool(self, broken=None):
+        """Return the process pool, starting it if this process has none.
+
+        Pass a pool that raised BrokenProcessPool as broken to have it
+        replaced, unless another thread has already done so.
+        """
+        with self.lock:
+            # A forked web worker can't use its parent's pool.
+            if self.pool is None or self.pool is broken \
+                    or self.pid != os.getpid():
+                if broken is not None and self.pool is broken:
+                    broken.shutdown(wait=False)
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers)
+                self.pid = os.getpid()
+            return self.pool
+
+    def hash(self, password, salt, n, r, p):
+        """Return utils.hash_password(password, salt, n, r, p).
+
+        Raises:
+            HashingOverloaded: If the queue is full, or the hash isn't done
+                within the timeout.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise HashingOverloaded()
+        if not self.workers:
+            try:
+                return utils.hash_password(password, salt, n, r, p)
+            finally:
+                self.slots.release()
+        pool = future = None
+        try:
+            for retry in (False, True):
+                pool = self.get_pool(pool)
+                try:
+                    future = pool.submit(utils.hash_password, password, salt,
+                                         n, r, p)
+                    return future.result(self.timeout)
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory), which breaks
+                    # the whole pool, so try once more on a new one.
+                    future = None
+                    if retry:
+                        raise
+        except concurrent.futures.TimeoutError:
+            raise HashingOverloaded()
+        finally:
+            # A hash that times out still occupies a worker until it's done.
+            if future is None:
+                self.slots.release()
+            else:
+                future.add_done_callback(lambda future: self.slots.release())
+
+
+def get_executor():
+    """Return the hash executor for the current app."""
+    return current_app.extensions["hash_executor"]
+
+
+def get_params():
+    """Return configured scrypt (n, r, p) for new hashes."""
+    config = current_app.config
+    return (config["HASH_SCRYPT_N"], config["HASH_SCRYPT_R"],
+            config["HASH_SCRYPT_P"])
+
+
+def parse_hash(stored):
+    """Split a stored hash into ((n, r, p), hex digest)."""
+    if not stored.startswith("scrypt$"):
+        return LEGACY_PARAMS, stored
+    _, n, r, p, digest = stored.split("$")
+    return (int(n), int(r), int(p)), digest
+
+
+def hash_password(password, salt):
+    """Hash password/salt with the configured parameters, for storage."""
+    n, r, p = get_params()
+    digest = get_executor().hash(password, salt, n, r, p)
+    return "scrypt${0}${1}${2}${3}".format(n, r, p, digest)
+
+
+def check_password(password, salt, stored):
+    """Return whether password/salt matches a hash from hash_password."""
+    (n, r, p), digest = parse_hash(stored)
+    candidate = get_executor().hash(password, salt, n, r, p)
+    # Compare given hash with known hash using safe comparison function
+    return hmac.compare_digest(digest, candidate)
+
+
+def measure_rate(hash_batch, seconds):
+    """Call hash_batch() repeatedly for seconds, return hashes per second.
+
+    hash_batch returns how many hashes it computed.
+    """
+    hashes = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        hashes += hash_batch()
+    return hashes / (time.perf_counter() - start)
+
+
+@click.command("bench-hash")
+@click.option("--seconds", type=float, default=5,
+              help="How long to hash for, per measurement.")
+@with_appcontext
+def bench_hash_command(seconds):
+    """Report password hashing throughput at the current settings."""
+    n, r, p = get_params()
+    workers = current_app.config["HASH_WORKERS"]
+    salt = utils.get_poll_salt("benchmark", 0)
+    args = ("benchmark password", salt, n, r, p)
+
+    def hash_one():
+        utils.hash_password(*args)
+        return 1
+
+    rate = measure_rate(hash_one, seconds)
+    click.echo("scrypt n={0} r={1} p={2}: {3:.1f} hashes/sec on one core"
+               .format(n, r, p, rate))
+    if workers:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+
+            def hash_batch():
+                futures = [pool.submit(utils.hash_password, *args)
+                           for _ in range(workers)]
+                return len([f.result() for f in futures])
+
+            rate = measure_rate(hash_batch, seconds)
+        click.echo("{0:.1f} hashes/sec with HASH_WORKERS={1} "
+                   "({2:.1f} per worker)".format(rate, workers,
+                                                 rate / workers))
+
+
+def init_app(app):
+    app.extensions["hash_executor"] = HashExecutor(
+        app.config["HASH_WORKERS"], app.config["HASH_QUEUE_LIMIT"],
+        app.config["HASH_TIMEOUT"])
+    app.cli.add_command(bench_hash_command)
@@ -0,0 +1,185 @@
+"""Vote ingestion, optionally group-committed in batches.
+
+With VOTE_INGEST = "direct" each vote is written by its own request, in its
+own transaction. With VOTE_INGEST = "batched" validated votes are put on an
+in-process queue and a writer thread stores them in one transaction per
+batch: up to VOTE_BATCH_SIZE votes, or whatever arrived within
+VOTE_BATCH_LATENCY seconds of the first. Identical (poll, ballot) pairs in a
+batch are merged into a single row update.
+
+If VOTE_WAIT_FOR_COMMIT is set, a request returns only once its batch has
+committed, so an acknowledged vote is as durable as a direct write. If not,
+votes still queued when the process dies are lost. Queued votes are flushed
+at interpreter exit, so a clean worker shutdown loses nothing.
+"""
+
+import atexit
+import queue
+import threading
+import time
+
+from flask import current_app
+
+import db_funcs
+
+
+# Outcomes of record_vote.
+STORED = "stored"
+PENDING = "pending"
+FAILED = "failed"
+REPLAYED = "replayed"
+MISSING = "missing"
+# Outcomes by what db_funcs.add_votes returned for a vote.
+OUTCOMES = {True: STORED, False: REPLAYED, None: MISSING}
+
+
+class PendingVote:
+    """A validated vote waiting to be written, with its cookie update."""
+
+    __slots__ = ("poll_id", "ballot", "cookie_id", "cookie_hash",
+                 "generation", "last_seen", "done", "outcome")
+
+    def __init__(self, poll_id, ballot, cookie_id, cookie_hash, generation,
+                 last_seen):
+        self.poll_id = poll_id
+        self.ballot = ballot
+        self.cookie_id = cookie_id
+        self.cookie_hash = cookie_hash
+        self.generation = generation
+        self.last_seen = last_seen
+        self.done = threading.Event()
+        self.outcome = FAILED
+
+
+class VoteWriter:
+    """Background thread writing queued votes in batched transactions."""
+
+    # Queued in place of a vote to tell the writer thread to stop.
+    STOP = object()
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.exit_registered = False
+
+    def submit(self, vote):
+        """Queue a PendingVote, starting the writer thread if necessary."""
+        self.start()
+        self.queue.put(vote)
+
+    def start(self):
+        """Start the writer thread, if not already running."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name="vote-writer",
+                                           daemon=True)
+            # stop() stops whichever thread is running, so once will do.
+            if not self.exit_registered:
+                atexit.register(self.stop)
+                self.exit_registered = True
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        """Write out any queued votes and stop the writer thread."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(self.STOP)
+            thread.join(timeout)
+
+    def _run(self):
+        batch_size = self.app.config["VOTE_BATCH_SIZE"]
+        latency = self.app.config["VOTE_BATCH_LATENCY"]
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is self.STOP:
+                return
+            batch = [first]
+            deadline = time.monotonic() + latency
+            while len(batch) < batch_size:
+                try:
+                    vote = self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if vote is self.STOP:
+                    # Finish this batch, then drain whatever else is queued.
+                    stopping = True
+                    break
+                batch.append(vote)
+            if stopping:
+                while True:
+                    try:
+                        vote = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if vote is not self.STOP:
+                        batch.append(vote)
+            self.write(batch)
+
+    def write(self, batch):
+        """Store a batch of votes, isolating any that can't be written."""
+        with self.app.app_context():
+            try:
+                write_votes(batch)
+            except Exception:
+                # One bad vote shouldn't sink the rest, so retry them one
+                # at a time.
+                for vote in batch:
+                    try:
+                        write_votes([vote])
+                    except Exception as e:
+                        self.app.logger.error("Failed to store vote: {0}"
+                                              .format(e))
+        for vote in batch:
+            vote.done.set()
+
+
+def write_votes(votes):
+    """Store PendingVotes in one transaction, recording their outcomes."""
+    accepted = db_funcs.add_votes(
+        [(vote.poll_id, vote.ballot, vote.cookie_id, vote.cookie_hash,
+          vote.generation, vote.last_seen) for vote in votes])
+    for vote, ok in zip(votes, accepted):
+        vote.outcome = OUTCOMES[ok]
+
+
+def record_vote(poll_id, ballot, cookie_id, cookie_hash, generation,
+                last_seen):
+    """Store a validated vote and rotate the voter's cookie.
+
+    Pass the new cookie_hash for database sessions, or the session's
+    current generation (and no hash) for signed sessions.
+
+    Returns:
+        str: STORED, FAILED if the vote couldn't be written, REPLAYED if
+            the signed session's generation was stale, MISSING if the poll
+            no longer exists, or PENDING if a queued vote hadn't been
+            written within VOTE_COMMIT_TIMEOUT. It stays queued, so will
+            most likely be stored shortly.
+    """
+    config = current_app.config
+    if config["VOTE_INGEST"] != "batched":
+        # One transaction, so a cookie is never rotated without its vote.
+        accepted, = db_funcs.add_votes(
+            [(poll_id, ballot, cookie_id, cookie_hash, generation,
+              last_seen)])
+        return OUTCOMES[accepted]
+    vote = PendingVote(poll_id, ballot, cookie_id, cookie_hash, generation,
+                       last_seen)
+    current_app.extensions["vote_writer"].submit(vote)
+    if config["VOTE_WAIT_FOR_COMMIT"]:
+        if not vote.done.wait(config["VOTE_COMMIT_TIMEOUT"]):
+            # Still in flight; reporting failure would invite a second vote.
+            return PENDING
+        return vote.outcome
+    return STORED
+
+
+def init_app(app):
+    app.extensions["vote_writer"] = VoteWriter(app)
@@ -0,0 +1,170 @@
+"""Live results pushed to watching browsers with Server-Sent Events.
+
+Each poll being watched has one channel, fed by a single publisher thread
+per process. Every LIVE_POLL_INTERVAL seconds the publisher reads the
+stored results of all watched polls in one query, asks the results worker
+for a recount of any with uncounted votes (at most every UPDATE_INTERVAL),
+and hands each new version to the channel's subscribers. However many
+people watch a poll, it costs one recount and one cheap queue write each.
+
+Each subscriber holds a server thread for as long as it's connected, so at
+most LIVE_MAX_SUBSCRIBERS are allowed per process.
+"""
+
+from datetime import datetime
+import json
+import queue
+import threading
+
+from flask import current_app
+
+import db_funcs
+import tally
+
+
+class Channel:
+    """Latest results of one poll and the queues of its subscribers."""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.version = None
+        self.message = None
+
+
+class ResultsPublisher:
+    """Fans out new versions of poll results to subscriber queues."""
+
+    def __init__(self, app, request_recount):
+        """Create publisher for app, requesting recounts by poll id."""
+        self.app = app
+        self.request_recount = request_recount
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def subscribe(self, poll_id):
+        """Return a queue of (version, message) for poll's new results.
+
+        Returns None if the process already has LIVE_MAX_SUBSCRIBERS.
+        """
+        with self.lock:
+            total = sum(len(channel.subscribers)
+                        for channel in self.channels.values())
+            if total >= self.app.config["LIVE_MAX_SUBSCRIBERS"]:
+                return None
+            channel = self.channels.setdefault(poll_id, Channel())
+            # Subscribers only ever need the latest version.
+            subscriber = queue.Queue(maxsize=1)
+            if channel.message is not None:
+                subscriber.put((channel.version, channel.message))
+            channel.subscribers.add(subscriber)
+        self.start()
+        self.wakeup.set()
+        return subscriber
+
+    def unsubscribe(self, poll_id, subscriber):
+        """Stop sending results to a subscriber queue."""
+        with self.lock:
+            channel = self.channels.get(poll_id)
+            if channel is None:
+                return
+            channel.subscribers.discard(subscriber)
+            if not channel.subscribers:
+                del self.channels[poll_id]
+
+    def publish(self, poll_id, version, message):
+        """Send a version of poll's results to its subscribers, if new."""
+        with self.lock:
+            channel = self.channels.get(poll_id)
+            if channel is None or channel.version == version:
+                return
+            channel.version = version
+            channel.message = message
+            for subscriber in channel.subscribers:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait((version, message))
+
+    def check(self):
+        """Publish new results of watched polls, requesting any recounts."""
+        with self.lock:
+            poll_ids = list(self.channels)
+        if not poll_ids:
+            return
+        update_target = (int(datetime.now().timestamp())
+                         - self.app.config["UPDATE_INTERVAL"])
+        for row in db_funcs.get_live_results(poll_ids):
+            if row["open"] and row["early_results"] and (
+                    row["results_votes_cast"] is None
+                    or (row["results_votes_cast"] != row["votes_cast"]
+                        and row["last_update"] < update_target)):
+                self.request_recount(row["id"])
+            if row["results_json"] is None:
+                continue
+            version = "{0}-{1}-{2}".format(row["results_votes_cast"],
+                                           row["last_update"], row["final"])
+            results = json.loads(row["results_json"])
+            message = json.dumps({"results": results,
+                                  "winners": tally.winners(results),
+                                  "final": bool(row["final"])})
+            self.publish(row["id"], version, message)
+
+    def wake(self):
+        """Have the publisher check for new results now."""
+        self.wakeup.set()
+
+    def start(self):
+        """Start the publisher thread, if not already running."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name="results-publisher",
+                                           daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                with self.app.app_context():
+                    self.check()
+            except Exception:
+                self.app.logger.exception("Results publisher failed")
+            self.wakeup.wait(self.app.config["LIVE_POLL_INTERVAL"])
+
+
+def get_publisher():
+    """Return the results publisher for the current app."""
+    return current_app.extensions["results_publisher"]
+
+
+def event_stream(publisher, poll_id, subscriber, last_event_id, keepalive):
+    """Generate the text/event-stream for one subscriber.
+
+    Ends after sending final results, or when the client goes away.
+    """
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                version, message = subscriber.get(timeout=keepalive)
+            except queue.Empty:
+                # Comment line, to keep proxies from timing out the stream.
+                yield ": keepalive\n\n"
+                continue
+            if version != last_event_id:
+                yield "event: results\nid: {0}\ndata: {1}\n\n".format(
+                    version, message)
+            if json.loads(message)["final"]:
+                return
+    finally:
+        publisher.unsubscribe(poll_id, subscriber)
+
+
+def init_app(app, request_recount):
+    app.extensions["results_publisher"] = ResultsPublisher(app,
+                                                           request_recount)
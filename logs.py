@@ -0,0 +1,207 @@
+"""Logging through a background writer.
+
+Handlers that write to files or streams are moved behind a queue: the
+thread that logs only copies what it needs from the request (URL, remote
+address and the timing fields from metrics.annotate) onto the record and
+queues it, and a QueueListener thread formats and writes it. Should the
+writer fall LOG_QUEUE_SIZE records behind, further records are dropped and
+counted rather than keep a request waiting.
+
+The app log rotates at LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files.
+LOG_FORMAT = "json" writes one JSON object per line instead of text.
+"""
+
+import atexit
+import copy
+from datetime import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+from flask import has_request_context, request
+from flask.logging import default_handler
+
+import metrics
+
+TEXT_FORMAT = ("[%(asctime)s] %(remote_addr)s requested %(url)s\n"
+               "%(levelname)s in %(module)s: %(message)s")
+CONSOLE_FORMAT = "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+# Request fields copied onto records by RequestInfoFilter.
+REQUEST_FIELDS = ("url", "remote_addr", "request_time", "db_queries",
+                  "db_time", "render_time", "recount_time")
+# Not handled in the background, so can report on the background writer.
+logger = logging.getLogger(__name__)
+# Longest wait at exit for the writer to make room for, and reach, the
+# end of its queue.
+STOP_TIMEOUT = 5
+
+
+class RequestInfoFilter(logging.Filter):
+    """Copies request details onto records while still in the request."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.url = request.url
+            record.remote_addr = request.remote_addr
+        else:
+            record.url = None
+            record.remote_addr = None
+        metrics.annotate(record)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(),
+                 "level": record.levelname,
+                 "module": record.module,
+                 "message": record.getMessage()}
+        for field in REQUEST_FIELDS:
+            entry[field] = getattr(record, field, None)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class BackgroundListener(logging.handlers.QueueListener):
+    """QueueListener whose stop() gives up on a stuck writer."""
+
+    def stop(self, timeout=None):
+        """Write out anything queued and stop, waiting at most timeout.
+
+        Returns:
+            int: Number of records left unwritten, roughly; one may be
+                part way through being written.
+        """
+        # QueueListener's put_nowait fails outright on a full queue.
+        try:
+            self.queue.put(self._sentinel, timeout=timeout)
+        except queue.Full:
+            return self.queue.qsize()
+        self._thread.join(timeout)
+        # A writer still going hasn't reached the sentinel, so count the
+        # record it's on in its place.
+        unwritten = self.queue.qsize() if self._thread.is_alive() else 0
+        self._thread = None
+        return unwritten
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Queues records for handlers run by a QueueListener thread.
+
+    The listener is started on first use in each process, so a server that
+    forks workers after importing the app still gets one per worker.
+    """
+
+    def __init__(self, handlers, maxsize):
+        super().__init__(None)
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.listener = None
+        self.pid = None
+        # Not self.lock, which Handler already holds around emit().
+        self.listener_lock = threading.Lock()
+        self.dropped = 0
+        self.exit_registered = False
+
+    def start(self):
+        """Start this process's listener, if not already running."""
+        with self.listener_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.maxsize)
+            self.listener = BackgroundListener(
+                self.queue, *self.handlers, respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+            # Forked processes inherit the registration, and stop() only
+            # stops the listener of the process it's called in.
+            if not self.exit_registered:
+                atexit.register(self.stop)
+                self.exit_registered = True
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Write out anything queued and stop the listener.
+
+        Waits at most timeout seconds for the writer; any records it hasn't
+        got to by then are lost.
+        """
+        with self.listener_lock:
+            if self.pid != os.getpid():
+                return
+            self.pid = None
+            unwritten = self.listener.stop(timeout)
+            if unwritten:
+                logger.warning("Log writer stopped with {0} records "
+                               "unwritten".format(unwritten))
+
+    def prepare(self, record):
+        # Format the message and any traceback now, since the arguments
+        # and exception may not survive until the listener gets to them.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def add_background_handlers(app, logger, handlers):
+    """Have logger write to handlers from a background thread.
+
+    Returns:
+        BackgroundHandler: Handler added to logger.
+    """
+    background_handler = BackgroundHandler(handlers,
+                                           app.config["LOG_QUEUE_SIZE"])
+    background_handler.addFilter(RequestInfoFilter())
+    logger.addHandler(background_handler)
+    app.extensions.setdefault("log_handlers", []).append(background_handler)
+    return background_handler
+
+
+def rotating_file_handler(app, path, formatter):
+    """Return handler writing to path, rotating at LOG_MAX_BYTES."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=app.config["LOG_MAX_BYTES"],
+        backupCount=app.config["LOG_BACKUP_COUNT"])
+    handler.setFormatter(formatter)
+    return handler
+
+
+def init_app(app):
+    if app.config["LOG_FORMAT"] == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    file_handler = rotating_file_handler(
+        app, os.path.join(app.instance_path, "logs", "stickpoll.log"),
+        formatter)
+    file_handler.setLevel(logging.INFO)
+    # Takes the place of Flask's own handler, which writes to the console
+    # from the request thread.
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    app.logger.removeHandler(default_handler)
+    add_background_handlers(app, app.logger, [file_handler, console_handler])
+    app.logger.setLevel(logging.INFO)
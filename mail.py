@@ -1,23 +1,188 @@
-"""Module for sending emails."""
+"""Module for sending emails.
 
-from flask import current_app, g
-from flask_sendgrid import SendGrid
+send_mail only adds the email to the Outbox table; a sender delivers it
+later, in batches of up to MAIL_BATCH_SIZE, through the MAIL_TRANSPORT:
 
-def get_mail_context():
-    """Fetch or generate SendGrid mailer object."""
-    if "main" not in g:
-        mail = SendGrid(current_app)
-        g.mail = mail
-    return g.mail
+    sendgrid: SendGrid's API, sharing one HTTP client.
+    file: one JSON file per email in MAIL_FILE_DIRECTORY, for development.
+    memory: kept in a list on the transport, for tests.
+
+Failed emails are retried after MAIL_RETRY_DELAY seconds, doubling each
+time, up to MAIL_MAX_ATTEMPTS attempts. The sender runs as a thread in the
+web process (MAIL_SENDER = "thread") or as `flask send-mail`
+(MAIL_SENDER = "external").
+"""
+
+import binascii
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import db_funcs
+
+class SendGridTransport:
+    """Deliver emails through SendGrid."""
+
+    def __init__(self, app):
+        from flask_sendgrid import SendGrid
+        self.app = app
+        self.mailer_class = SendGrid
+        # The client holds the HTTP session; messages are built fresh each
+        # time since a SendGrid object accumulates its recipients.
+        self.client = SendGrid(app).client
+
+    def send(self, subject, html, sender, recipient):
+        mailer = self.mailer_class()
+        mailer.app = self.app
+        mailer.default_from = self.app.config["SENDGRID_DEFAULT_FROM"]
+        mailer.client = self.client
+        r = mailer.send_email(from_email=sender,
+                              to_email=recipient,
+                              subject=subject,
+                              html=html)
+        if r.status_code != 202:
+            raise RuntimeError("Unexpected email response: {0}"
+                               .format(r.status_code))
+
+class FileTransport:
+    """Write each email to a JSON file instead of sending it."""
+
+    def __init__(self, app):
+        self.directory = app.config["MAIL_FILE_DIRECTORY"]
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, subject, html, sender, recipient):
+        name = "{0}-{1}.json".format(
+            datetime.now().strftime("%Y%m%d%H%M%S"),
+            binascii.hexlify(os.urandom(4)).decode("ascii"))
+        with open(os.path.join(self.directory, name), "w") as f:
+            json.dump({"subject": subject, "html": html, "sender": sender,
+                       "recipient": recipient}, f)
+
+class MemoryTransport:
+    """Keep emails in a list instead of sending them."""
+
+    def __init__(self, app):
+        self.sent = []
+
+    def send(self, subject, html, sender, recipient):
+        self.sent.append({"subject": subject, "html": html, "sender": sender,
+                          "recipient": recipient})
+
+TRANSPORTS = {"sendgrid": SendGridTransport,
+              "file": FileTransport,
+              "memory": MemoryTransport}
+
+class MailSender:
+    """Delivers emails from the outbox through the app's transport."""
+
+    def __init__(self, app):
+        self.app = app
+        self.transport = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get_transport(self):
+        """Return the transport, creating it on first use."""
+        with self.lock:
+            if self.transport is None:
+                transport_class = TRANSPORTS[self.app.config["MAIL_TRANSPORT"]]
+                self.transport = transport_class(self.app)
+            return self.transport
+
+    def send_due(self):
+        """Send one batch of due emails. Return how many were claimed."""
+        config = self.app.config
+        now = int(datetime.now().timestamp())
+        claim = binascii.hexlify(os.urandom(16)).decode("ascii")
+        emails = db_funcs.claim_emails(claim, config["MAIL_BATCH_SIZE"],
+                                       config["MAIL_MAX_ATTEMPTS"],
+                                       now + config["MAIL_CLAIM_TIMEOUT"])
+        if not emails:
+            return 0
+        transport = self.get_transport()
+        for email in emails:
+            try:
+                transport.send(email["subject"], email["html"],
+                               email["sender"], email["recipient"])
+            except Exception as e:
+                delay = config["MAIL_RETRY_DELAY"] * 2**email["attempts"]
+                self.app.logger.error("Problem sending email {0}: {1}"
+                                      .format(email["id"], e))
+                db_funcs.mark_email_failed(email["id"],
+                                           int(datetime.now().timestamp())
+                                           + delay,
+                                           str(e))
+            else:
+                db_funcs.mark_email_sent(email["id"])
+        return len(emails)
+
+    def send_all_due(self):
+        """Send batches until no emails are due."""
+        while self.send_due() == self.app.config["MAIL_BATCH_SIZE"]:
+            pass
+
+    def wake(self):
+        """Have the sender thread check the outbox now."""
+        if self.app.config["MAIL_SENDER"] == "thread":
+            self.start()
+            self.wakeup.set()
+
+    def start(self):
+        """Start the in-process sender thread, if not already running."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name="mail-sender",
+                                           daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                with self.app.app_context():
+                    self.send_all_due()
+            except Exception:
+                self.app.logger.exception("Mail sender failed")
+            # Also wakes periodically for retries and other processes' mail.
+            self.wakeup.wait(self.app.config["MAIL_POLL_INTERVAL"])
+
+def get_sender():
+    """Return the mail sender for the current app."""
+    return current_app.extensions["mail_sender"]
 
 def send_mail(subject, html, sender, recipient):
-    """Send email."""
-    mail = get_mail_context()
-    r = mail.send_email(from_email=sender,
-                        to_email=recipient,
-                        subject=subject,
-                        html=html)
-    if r.status_code != 202:
-        current_app.logger.error("Unexpected email response: {0}"
-                                 .format(r.status_code))
-    return r
+    """Queue email for sending. Return its outbox id."""
+    email_id = db_funcs.queue_email(sender, recipient, subject, html)
+    get_sender().wake()
+    return email_id
+
+@click.command("send-mail")
+@click.option("--once", is_flag=True,
+              help="Send the emails that are due and exit.")
+@with_appcontext
+def send_mail_command(once):
+    """Send queued emails, checking every MAIL_POLL_INTERVAL seconds."""
+    mail_sender = get_sender()
+    while True:
+        mail_sender.send_all_due()
+        if once:
+            return
+        time.sleep(current_app.config["MAIL_POLL_INTERVAL"])
+
+def init_app(app):
+    mail_sender = MailSender(app)
+    app.extensions["mail_sender"] = mail_sender
+    app.cli.add_command(send_mail_command)
+    if app.config["MAIL_SENDER"] == "thread":
+        # Pick up anything left unsent by a previous run.
+        app.before_first_request(mail_sender.start)
@@ -0,0 +1,151 @@
+"""Retention and housekeeping for the database.
+
+Stale cookies, ballots which finalised results no longer need, results of
+deleted polls and emails sent over MAIL_RETENTION seconds ago are removed
+MAINTENANCE_CHUNK_SIZE rows at a time, each chunk in its own short
+transaction with a MAINTENANCE_PAUSE between them, so votes are never kept
+waiting on the write lock for long. Freed pages are
+then handed back to the filesystem (for databases using incremental
+auto-vacuum) and the query planner's statistics refreshed.
+
+Run it with `flask maintain-db`, from cron or with --interval, or set
+MAINTENANCE_INTERVAL to run it from a thread in the web process.
+"""
+
+from datetime import datetime
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from db import get_db, query_db
+import db_funcs
+
+
+def delete_in_chunks(delete_chunk):
+    """Call delete_chunk(limit) until it deletes nothing. Return total."""
+    config = current_app.config
+    total = 0
+    while True:
+        deleted = delete_chunk(config["MAINTENANCE_CHUNK_SIZE"])
+        total += deleted
+        if deleted < config["MAINTENANCE_CHUNK_SIZE"]:
+            return total
+        # Let any waiting writers in before the next chunk.
+        time.sleep(config["MAINTENANCE_PAUSE"])
+
+
+def incremental_vacuum():
+    """Release free pages in small steps. Return number of steps taken.
+
+    Does nothing unless the database uses incremental auto-vacuum; see
+    `flask maintain-db --vacuum` for converting an older database.
+    """
+    config = current_app.config
+    row = query_db("PRAGMA auto_vacuum", one=True, raw=True)
+    if row[0] != 2:
+        return 0
+    db = get_db()
+    steps = 0
+    while query_db("PRAGMA freelist_count", one=True, raw=True)[0]:
+        list(db.execute("PRAGMA incremental_vacuum({0:d})"
+                        .format(config["MAINTENANCE_CHUNK_SIZE"])))
+        steps += 1
+        time.sleep(config["MAINTENANCE_PAUSE"])
+    return steps
+
+
+def run_maintenance():
+    """Run every retention and housekeeping task once.
+
+    Returns:
+        dict: Number of rows deleted per table.
+    """
+    now = int(datetime.now().timestamp())
+    cutoff = now - current_app.config["COOKIE_RETENTION"]
+    deleted = {
+        "cookies": delete_in_chunks(
+            lambda limit: db_funcs.delete_stale_cookies(cutoff, limit)),
+        "ballots": delete_in_chunks(db_funcs.delete_finalised_ballots),
+        "results": delete_in_chunks(db_funcs.delete_orphaned_results),
+        "emails": delete_in_chunks(
+            lambda limit: db_funcs.delete_sent_emails(
+                now - current_app.config["MAIL_RETENTION"], limit)),
+    }
+    incremental_vacuum()
+    get_db().execute("PRAGMA optimize")
+    current_app.logger.info("Maintenance deleted {0} cookies, {1} ballots, "
+                            "{2} results, {3} emails"
+                            .format(deleted["cookies"], deleted["ballots"],
+                                    deleted["results"], deleted["emails"]))
+    return deleted
+
+
+def convert_to_incremental_vacuum():
+    """Switch database to incremental auto-vacuum with a full VACUUM.
+
+    This rewrites the whole file and holds the write lock throughout, so
+    it's for a quiet moment rather than the regular schedule.
+    """
+    db = get_db()
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("VACUUM")
+
+
+class MaintenanceThread:
+    """Runs maintenance every MAINTENANCE_INTERVAL seconds in the app."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Start the maintenance thread, if not already running."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name="maintenance",
+                                           daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.app.config["MAINTENANCE_INTERVAL"])
+            try:
+                with self.app.app_context():
+                    run_maintenance()
+            except Exception:
+                self.app.logger.exception("Maintenance failed")
+
+
+@click.command("maintain-db")
+@click.option("--interval", type=int, default=None,
+              help="Keep running, every this many seconds.")
+@click.option("--vacuum", is_flag=True,
+              help="First convert the database to incremental auto-vacuum "
+                   "with a full VACUUM, locking it until done.")
+@with_appcontext
+def maintain_db_command(interval, vacuum):
+    """Delete expired data and tidy up the database."""
+    if vacuum:
+        convert_to_incremental_vacuum()
+        click.echo("Converted database to incremental auto-vacuum.")
+    while True:
+        deleted = run_maintenance()
+        for table, count in deleted.items():
+            click.echo("Deleted {0} {1}.".format(count, table))
+        if interval is None:
+            return
+        time.sleep(interval)
+
+
+def init_app(app):
+    app.cli.add_command(maintain_db_command)
+    if app.config["MAINTENANCE_INTERVAL"]:
+        maintenance_thread = MaintenanceThread(app)
+        app.extensions["maintenance_thread"] = maintenance_thread
+        app.before_first_request(maintenance_thread.start)
@@ -0,0 +1,282 @@
+"""Request and database metrics, served to Prometheus at /metrics.
+
+With METRICS_ENABLED, every statement run on a pooled connection is timed
+(see db.instrument), and every template with Flask's rendering signals.
+Each request's totals (queries, database time, render time and recount
+time) are kept on flask.g, attached to the request's log records (see
+annotate), and added to histograms by endpoint. Requests slower than
+METRICS_LOG_THRESHOLD seconds are logged along with their totals.
+
+With METRICS_ENABLED off none of the hooks are installed and /metrics
+isn't served. Figures are per process, so scrape each one. /metrics only
+answers clients in METRICS_ALLOWED_IPS, or sending METRICS_TOKEN (if set)
+as an "Authorization: Bearer" header; behind a proxy, the allowed address
+is the proxy's.
+"""
+
+from bisect import bisect_left
+import hmac
+import threading
+import time
+
+from flask import abort, current_app, g, has_app_context, request, Response
+from flask.signals import before_render_template, template_rendered
+
+import cache
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Prometheus histogram, optionally split by a single label."""
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        # [count per bucket (last is +Inf), sum] by label value.
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        """Record one observation."""
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [
+                    [0]*(len(self.buckets) + 1), 0]
+            series[0][i] += 1
+            series[1] += value
+
+    def exposition(self):
+        """Return lines of the Prometheus text format."""
+        lines = ["# HELP {0} {1}".format(self.name, self.help_text),
+                 "# TYPE {0} histogram".format(self.name)]
+        with self.lock:
+            series = sorted((k, list(v[0]), v[1])
+                            for k, v in self.series.items())
+        for label_value, counts, total in series:
+            if self.label is None:
+                labels = ""
+            else:
+                labels = '{0}="{1}",'.format(self.label,
+                                             escape_label(label_value))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(
+                    self.name, labels, bound, cumulative))
+            labels = "{{{0}}}".format(labels.rstrip(",")) if labels else ""
+            lines.append("{0}_sum{1} {2!r}".format(self.name, labels, total))
+            lines.append("{0}_count{1} {2}".format(self.name, labels,
+                                                   cumulative))
+        return lines
+
+
+class RequestMetrics:
+    """Running totals for one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.recount_time = 0.0
+        self.render_start = None
+
+
+class Metrics:
+    """The app's histograms and the hooks that feed them."""
+
+    def __init__(self, app):
+        self.app = app
+        self.request_seconds = Histogram(
+            "stickpoll_request_duration_seconds",
+            "Time to handle a request.", DURATION_BUCKETS, "endpoint")
+        self.request_queries = Histogram(
+            "stickpoll_request_db_queries",
+            "Database statements run per request.", QUERY_COUNT_BUCKETS,
+            "endpoint")
+        self.request_db_seconds = Histogram(
+            "stickpoll_request_db_seconds",
+            "Database time per request.", DURATION_BUCKETS, "endpoint")
+        self.request_render_seconds = Histogram(
+            "stickpoll_request_render_seconds",
+            "Template rendering time per request.", DURATION_BUCKETS,
+            "endpoint")
+        self.query_seconds = Histogram(
+            "stickpoll_db_query_duration_seconds",
+            "Time to run a database statement.", DURATION_BUCKETS)
+        self.recount_seconds = Histogram(
+            "stickpoll_recount_duration_seconds",
+            "Time to count a poll's results.", DURATION_BUCKETS)
+        self.histograms = [self.request_seconds, self.request_queries,
+                           self.request_db_seconds,
+                           self.request_render_seconds, self.query_seconds,
+                           self.recount_seconds]
+
+    def record_query(self, statement, bindings, seconds):
+        """Query observer adding a statement's run time to the totals."""
+        self.query_seconds.observe(seconds)
+        if has_app_context():
+            totals = g.get("request_metrics")
+            if totals is not None:
+                totals.queries += 1
+                totals.db_time += seconds
+
+    def start_request(self):
+        g.request_metrics = RequestMetrics()
+
+    def finish_request(self, e=None):
+        totals = g.get("request_metrics")
+        if totals is None:
+            return
+        elapsed = time.perf_counter() - totals.start
+        endpoint = request.endpoint or "none"
+        self.request_seconds.observe(elapsed, endpoint)
+        self.request_queries.observe(totals.queries, endpoint)
+        self.request_db_seconds.observe(totals.db_time, endpoint)
+        self.request_render_seconds.observe(totals.render_time, endpoint)
+        if elapsed >= self.app.config["METRICS_LOG_THRESHOLD"]:
+            self.app.logger.info(
+                "Slow request took {0:.0f} ms: {1} queries in {2:.0f} ms, "
+                "rendering {3:.0f} ms, recounting {4:.0f} ms".format(
+                    elapsed*1000, totals.queries, totals.db_time*1000,
+                    totals.render_time*1000, totals.recount_time*1000))
+        # Kept until now so the log record above gets the totals.
+        g.pop("request_metrics")
+
+    def start_render(self, sender, template, context, **extra):
+        totals = g.get("request_metrics")
+        if totals is not None:
+            totals.render_start = time.perf_counter()
+
+    def finish_render(self, sender, template, context, **extra):
+        totals = g.get("request_metrics")
+        if totals is not None and totals.render_start is not None:
+            totals.render_time += time.perf_counter() - totals.render_start
+            totals.render_start = None
+
+    def exposition(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.exposition()
+        cache_stats = sorted(cache.stats().items())
+        for stat, kind, help_text in (
+                ("hits", "counter", "Cache lookups that found a value."),
+                ("misses", "counter", "Cache lookups that found nothing."),
+                ("size", "gauge", "Entries held in a cache.")):
+            name = "stickpoll_cache_{0}{1}".format(
+                stat, "_total" if kind == "counter" else "")
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for cache_name, counts in cache_stats:
+                lines.append('{0}{{cache="{1}"}} {2}'.format(
+                    name, escape_label(cache_name), counts[stat]))
+        name = "stickpoll_log_records_dropped_total"
+        lines.append("# HELP {0} Log records dropped with the writer behind."
+                     .format(name))
+        lines.append("# TYPE {0} counter".format(name))
+        lines.append("{0} {1}".format(name, sum(
+            handler.dropped
+            for handler in self.app.extensions.get("log_handlers", []))))
+        return "\n".join(lines) + "\n"
+
+
+class Timer:
+    """Context manager adding its duration to a histogram and request."""
+
+    def __init__(self, histogram, field):
+        self.histogram = histogram
+        self.field = field
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed)
+        totals = g.get("request_metrics")
+        if totals is not None:
+            setattr(totals, self.field, getattr(totals, self.field) + elapsed)
+
+
+class NullTimer:
+    """Stands in for Timer when metrics are disabled."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def escape_label(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def recount_timer():
+    """Return a context manager timing a recount, if metrics are enabled."""
+    app_metrics = current_app.extensions.get("metrics")
+    if app_metrics is None:
+        return NULL_TIMER
+    return Timer(app_metrics.recount_seconds, "recount_time")
+
+
+def annotate(record):
+    """Attach the current request's totals so far to a log record.
+
+    Fields are None outside requests, or when metrics are disabled.
+    """
+    totals = g.get("request_metrics") if has_app_context() else None
+    if totals is None:
+        record.request_time = record.db_queries = record.db_time = None
+        record.render_time = record.recount_time = None
+    else:
+        record.request_time = time.perf_counter() - totals.start
+        record.db_queries = totals.queries
+        record.db_time = totals.db_time
+        record.render_time = totals.render_time
+        record.recount_time = totals.recount_time
+
+
+def authorised():
+    """Return whether the request may read /metrics."""
+    config = current_app.config
+    token = config["METRICS_TOKEN"]
+    if token:
+        given = request.headers.get("Authorization", "").encode("utf-8")
+        if hmac.compare_digest(given, "Bearer {0}".format(token)
+                               .encode("utf-8")):
+            return True
+    return request.remote_addr in config["METRICS_ALLOWED_IPS"]
+
+
+def metrics_view():
+    if not authorised():
+        abort(403)
+    return Response(current_app.extensions["metrics"].exposition(),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_app(app):
+    if not app.config["METRICS_ENABLED"]:
+        return
+    app_metrics = Metrics(app)
+    app.extensions["metrics"] = app_metrics
+    app.extensions.setdefault("query_observers", []).append(
+        app_metrics.record_query)
+    app.before_request(app_metrics.start_request)
+    app.teardown_request(app_metrics.finish_request)
+    before_render_template.connect(app_metrics.start_render, app)
+    template_rendered.connect(app_metrics.finish_render, app)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,163 @@
+"""Forward-only schema migrations for existing databases.
+
+schema.sql always describes the latest schema and records every migration
+below as applied, so a database created by init-db never needs migrating.
+Databases created earlier are brought up to date with `flask migrate-db`.
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from db import get_db, init_index_db, query_db
+import tally
+
+
+def table_columns(table):
+    """Return the column names of a table."""
+    return [row["name"] for row in query_db("PRAGMA table_info({0})"
+                                            .format(table))]
+
+
+def pack_ballots(db):
+    """Replace comma-joined Ballots.ballot_string with packed integers."""
+    if "ballot_string" not in table_columns("Ballots"):
+        return
+    packed_counts = {}
+    for row in query_db("SELECT question_id, ballot_string, count "
+                        "FROM Ballots"):
+        ranking = []
+        for choice in row["ballot_string"].split(","):
+            # Repeated choices never affect the count, so drop them.
+            if int(choice) not in ranking:
+                ranking.append(int(choice))
+        key = (row["question_id"], tally.pack_ballot(ranking))
+        packed_counts[key] = packed_counts.get(key, 0) + row["count"]
+    db.execute("DROP TABLE Ballots; "
+               "CREATE TABLE Ballots ("
+               " id INTEGER PRIMARY KEY,"
+               " ballot INTEGER NOT NULL,"
+               " count INTEGER DEFAULT 0,"
+               " question_id INTEGER,"
+               " FOREIGN KEY(question_id) REFERENCES Questions(id) "
+               "ON UPDATE CASCADE ON DELETE CASCADE)")
+    db.executemany("INSERT INTO Ballots (question_id, ballot, count) "
+                   "VALUES (?, ?, ?)",
+                   [(poll_id, ballot, count)
+                    for (poll_id, ballot), count in packed_counts.items()])
+
+
+def search_generation(db):
+    """Rebuild the search index with its SearchGeneration counter, if set up.
+
+    Databases without a search index get it from setup-index-db instead.
+    """
+    row = query_db("SELECT name FROM sqlite_master WHERE type = 'table' "
+                   "AND name = 'Questions_index'", one=True)
+    if row is not None:
+        init_index_db()
+
+
+# (version, name, migration) in the order they must be applied. A migration
+# is either an SQL script or a function taking a database cursor.
+MIGRATIONS = [
+    (1, "packed_ballots", pack_ballots),
+    (2, "votes_cast",
+     "ALTER TABLE Questions ADD COLUMN votes_cast INTEGER NOT NULL DEFAULT 0; "
+     "UPDATE Questions SET votes_cast = (SELECT IFNULL(SUM(count), 0) "
+     "FROM Ballots WHERE question_id = Questions.id); "
+     "ALTER TABLE Results ADD COLUMN votes_cast INTEGER"),
+    (3, "search_generation", search_generation),
+    (4, "hot_path_indexes",
+     # Merge duplicate rows the new unique indexes would reject, in one
+     # grouped pass rather than a correlated count per row.
+     "CREATE TEMP TABLE MergedBallots AS "
+     "SELECT MIN(id) AS id, ballot, SUM(count) AS count, question_id "
+     "FROM Ballots GROUP BY question_id, ballot; "
+     "DELETE FROM Ballots; "
+     "INSERT INTO Ballots (id, ballot, count, question_id) "
+     "SELECT id, ballot, count, question_id FROM MergedBallots; "
+     "DROP TABLE MergedBallots; "
+     "DELETE FROM Results WHERE id NOT IN "
+     "(SELECT MAX(id) FROM Results GROUP BY question_id); "
+     "CREATE UNIQUE INDEX Ballots_question_ballot "
+     "ON Ballots (question_id, ballot); "
+     "CREATE UNIQUE INDEX Results_question ON Results (question_id); "
+     "CREATE INDEX Choices_question ON Choices (question_id, choice_number); "
+     "CREATE INDEX Questions_open_close_date ON Questions (open, close_date); "
+     "CREATE INDEX Questions_open_id ON Questions (open, id)"),
+    (5, "cookie_generation",
+     "ALTER TABLE Cookies ADD COLUMN generation INTEGER NOT NULL DEFAULT 0"),
+    (6, "outbox",
+     "CREATE TABLE Outbox ("
+     " id INTEGER PRIMARY KEY,"
+     " sender TEXT NOT NULL,"
+     " recipient TEXT NOT NULL,"
+     " subject TEXT NOT NULL,"
+     " html TEXT NOT NULL,"
+     " created INTEGER NOT NULL,"
+     " attempts INTEGER NOT NULL DEFAULT 0,"
+     " next_attempt INTEGER NOT NULL,"
+     " claim TEXT,"
+     " sent INTEGER,"
+     " last_error TEXT); "
+     "CREATE INDEX Outbox_due ON Outbox (sent, next_attempt); "
+     "CREATE INDEX Outbox_claim ON Outbox (claim)"),
+    (7, "final_results",
+     "ALTER TABLE Results ADD COLUMN final INTEGER NOT NULL DEFAULT 0; "
+     # Ballots of closed polls may already be gone, so what's stored is
+     # as final as it'll get.
+     "UPDATE Results SET final = 1 WHERE question_id IN "
+     "(SELECT id FROM Questions WHERE open = 0)"),
+]
+
+
+def get_schema_version():
+    """Return the highest applied migration version, creating the table."""
+    get_db().execute("CREATE TABLE IF NOT EXISTS SchemaVersion ("
+                     "version INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+                     "applied INTEGER NOT NULL)")
+    row = query_db("SELECT MAX(version) AS version FROM SchemaVersion",
+                   one=True)
+    return row["version"] or 0
+
+
+def migrate():
+    """Apply outstanding migrations in order. Return the names applied."""
+    current = get_schema_version()
+    applied = []
+    db = get_db()
+    for version, name, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        db.execute("BEGIN")
+        try:
+            if callable(migration):
+                migration(db)
+            else:
+                db.execute(migration)
+            db.execute("INSERT INTO SchemaVersion (version, name, applied) "
+                       "VALUES (?, ?, ?)",
+                       (version, name, int(datetime.now().timestamp())))
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        applied.append(name)
+    return applied
+
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """Apply outstanding schema migrations."""
+    applied = migrate()
+    for name in applied:
+        click.echo("Applied migration {0}.".format(name))
+    if not applied:
+        click.echo("Database schema is up to date.")
+
+
+def init_app(app):
+    app.cli.add_command(migrate_db_command)
@@ -1,23 +1,29 @@
 """Blueprint for polls."""
 
 import binascii
-from collections import defaultdict
-from datetime import datetime, timedelta
-import hashlib
-import hmac
+from datetime import datetime, timedelta, timezone
 import json
 import os
-import random
 
-from flask import (abort, Blueprint, current_app, flash, redirect, render_template, request,
-                   session, url_for)
+import click
+from flask import (abort, Blueprint, current_app, flash, make_response, redirect,
+                   render_template, request, Response, session, url_for)
+from flask.cli import with_appcontext
 
+import cache
+import closer
 import db_funcs
 from forms import (EnterPasswordForm, EnterPasswordFormWithCaptcha,
                    NewPollForm, NewPollFormWithCaptcha, VoteForm,
                    VoteFormWithCaptcha, CaptchaOnlyForm)
+import hashing
+import ingest
+import live
 from mail import send_mail
+import metrics
+import tally
 import utils
+import worker
 
 bp = Blueprint("polls", __name__, url_prefix="/polls")
 
@@ -68,6 +74,7 @@ def new_poll():
     poll_id = db_funcs.add_poll(title, question, choices,
                                 int(closing_time.timestamp()), early_results,
                                 password, email)
+    closer.get_closer().schedule(poll_id, int(closing_time.timestamp()))
     if random_password:
         # Redirect to a page telling them what their password is.
         return render_template("random_password.html", poll_id=poll_id,
@@ -80,18 +87,39 @@ def new_poll():
 @bp.route("<int:poll_id>/", methods=("GET", "POST"))
 def get_poll(poll_id):
     """View function for get poll page."""
+    # Query database for poll details.
+    row = db_funcs.get_poll(poll_id)
+    if row is None:
+        abort(404)
+    if not row["open"] or row["close_date"] < datetime.now().timestamp():
+        if row["open"]:
+            # Poll is expired and should have been closed by now.
+            closer.get_closer().close_soon(poll_id)
+        # Redirect to results, before touching the session, so the redirect
+        # for a closed poll can be cached like its results.
+        response = redirect(url_for("polls.get_results", poll_id=poll_id))
+        if not row["open"]:
+            response.cache_control.public = True
+            response.cache_control.max_age = (
+                current_app.config["FINAL_RESULTS_MAX_AGE"])
+        return response
     if not utils.valid_session(session):
         # User couldn't present valid credentials, so generate clean ones.
         # TODO: Fix DB stuff to do this all at once?
+        session.pop("cookie_hash", None)
+        session.pop("session_token", None)
         cookie_id = db_funcs.new_cookie()
-        cookie_hash = binascii.hexlify(os.urandom(32)).decode("ascii")
         session["id"] = cookie_id
         session["votes"] = []
-        session["cookie_hash"] = cookie_hash
+        if current_app.config["SESSION_MODE"] == "signed":
+            session["session_token"] = utils.create_session_token(cookie_id, 0)
+        else:
+            cookie_hash = binascii.hexlify(os.urandom(32)).decode("ascii")
+            session["cookie_hash"] = cookie_hash
+            db_funcs.update_cookie(cookie_id, cookie_hash,
+                                   int(datetime.now().timestamp()))
         session.permanent = True
         session.modified = True
-        db_funcs.update_cookie(cookie_id, cookie_hash,
-                               int(datetime.now().timestamp()))
         current_app.logger.info("New session instantiated")
     # If the user looks trustworthy, don't ask them for a captcha.
     if len(session["votes"]) < 5:
@@ -101,16 +129,6 @@ def get_poll(poll_id):
     if current_app.config["DEBUG"]:
         # Recaptcha probably won't work
         form = VoteForm()
-    # Query database for poll details.
-    row = db_funcs.get_poll(poll_id)
-    if row is None:
-        abort(404)
-    if row["close_date"] < datetime.now().timestamp():
-        # Poll is expired and should be closed.
-        db_funcs.close_poll(poll_id)
-        generate_results(poll_id)
-        # Redirect to results.
-        return redirect(url_for("polls.get_results", poll_id=poll_id))
     # Check if the poll is in the user's voting record already.
     if poll_id in session["votes"]:
         already_voted = True
@@ -132,15 +150,16 @@ def get_poll(poll_id):
         # or does CSRF token work alone?
 
         # Which choices are recorded in the database?
-        valid_choices = [row["choice_number"]
-                         for row in db_funcs.get_choices(poll_id)]
+        valid_choices = [number for number, text
+                         in db_funcs.get_choices(poll_id)]
         choices = []
         # User should've sent their choice preferences like 1;2;3;4.
         # Split and iterate over them.
         for choice in form.ballot_json.data.split(";"):
             try:
                 # Is this choice a valid int? And is it in the database?
-                if int(choice) in valid_choices:
+                # Repeats can't affect the count, so only keep the first.
+                if int(choice) in valid_choices and int(choice) not in choices:
                     # If so store it in 'choices'.
                     choices.append(int(choice))
             # If not, ignore it.
@@ -149,18 +168,45 @@ def get_poll(poll_id):
         if len(choices) == 0:
             flash("You have to select at least one valid choice")
             return redirect(url_for("polls.get_poll", poll_id=poll_id))
-        # Serialise the vote for storage in database.
-        ballot_string = ",".join(map(str, choices))
-        db_funcs.add_vote(poll_id, ballot_string)
+        # Pack the vote into an integer for storage in database.
+        ballot = tally.pack_ballot(choices)
+        # Voting rotates the session's credentials, so an older copy of
+        # the session can't be replayed to vote again.
+        if current_app.config["SESSION_MODE"] == "signed":
+            cookie_hash = None
+            generation = utils.get_session_generation(session)
+        else:
+            cookie_hash = binascii.hexlify(os.urandom(32)).decode("ascii")
+            generation = None
+        outcome = ingest.record_vote(poll_id, ballot, session["id"],
+                                     cookie_hash, generation,
+                                     int(datetime.now().timestamp()))
+        if outcome == ingest.REPLAYED:
+            # Stale session; the next request will issue a clean one.
+            session.clear()
+            flash("Your session has expired, please try again")
+            return redirect(url_for("polls.get_poll", poll_id=poll_id))
+        if outcome == ingest.MISSING:
+            # Deleted by another process since this one cached it.
+            db_funcs.forget_poll(poll_id)
+            abort(404)
+        if outcome == ingest.FAILED:
+            flash("Your vote couldn't be recorded, please try again")
+            return redirect(url_for("polls.get_poll", poll_id=poll_id))
+        if outcome == ingest.PENDING:
+            flash("Your vote has been received and will be counted shortly")
         # Vote was successfully recorded; add poll to user's voting record.
         session["votes"].append(poll_id)
-        cookie_hash = binascii.hexlify(os.urandom(32)).decode("ascii")
-        session["cookie_hash"] = cookie_hash
+        if cookie_hash is None:
+            session["session_token"] = utils.create_session_token(
+                session["id"], generation + 1)
+        else:
+            session["cookie_hash"] = cookie_hash
         session.modified = True
-        db_funcs.update_cookie(session["id"], cookie_hash,
-                               int(datetime.now().timestamp()))
         if row["early_results"]:
-            # Early results enabled for this poll, send user to preview page.
+            # Early results enabled for this poll, get the count started and
+            # send user to preview page.
+            worker.get_worker().request(poll_id)
             return redirect(url_for("polls.get_results", poll_id=poll_id))
         else:
             # Early results not enabled, redirect to homepage.
@@ -172,8 +218,7 @@ def get_poll(poll_id):
     if datetime.now() >= close_date:
         return redirect(url_for("polls.get_results", poll_id=poll_id))
     early_results = row["early_results"]
-    choices = {row["choice_number"]: row["text"] for row in
-               db_funcs.get_choices(poll_id)}
+    choices = dict(db_funcs.get_choices(poll_id))
     choices_json = [{"name": v, "num": k} for k, v in choices.items()]
     return render_template("poll.html", title=title,
                                         question=question,
@@ -186,121 +231,172 @@ def get_poll(poll_id):
                                         already_voted=already_voted)
 
 def generate_results(poll_id):
-    """Count ballots for this poll by IRV and record results to database."""
-    # Seed the RNG for consistent tie-breaking.
-    random.seed(poll_id)
-    choices = [row["choice_number"] for row in db_funcs.get_choices(poll_id)]
-    choices = sorted(choices)
-    # Fetch 'ballots' dict: vote counts keyed by ballot strings.
-    # eg if 10 people voted 1,2,3 it's {"1,2,3": 10}.
-    ballots = db_funcs.get_ballots(poll_id)
-    # How many votes have been cast?
-    total_ballots = sum(ballots.values())
-    # Count how many ballots have each option as their first choice.
-    votes = {choice: sum([count for ballot, count in ballots.items()
-                          if ballot.split(",")[0] == str(choice)])
-             for choice in choices}
-    if total_ballots == 0:
-        # We have no votes! End early.
-        results_sequence = [votes]
-        db_funcs.update_results(poll_id, json.dumps(results_sequence))
+    """Count ballots for this poll by IRV and record results to database.
+
+    Results of a closed poll are recorded as final. Nothing is done if the
+    results are final already, or no votes have been cast since the last
+    count.
+    """
+    status = db_funcs.get_poll_status(poll_id)
+    if status is None:
+        return
+    votes_cast = status["votes_cast"]
+    final = not status["open"]
+    row = db_funcs.get_results(poll_id)
+    if row is not None and (row["final"] or row["votes_cast"] == votes_cast):
+        if final and not row["final"]:
+            db_funcs.freeze_results(poll_id)
+            live.get_publisher().wake()
+        return
+    with metrics.recount_timer():
+        # Reuse this process's tally if it's at the stored version,
+        # otherwise rebuild it from the database.
+        poll_tally = tally.get_tally(poll_id)
+        if poll_tally is None or poll_tally.version != votes_cast:
+            poll_tally = rebuild_tally(poll_id)
+            if poll_tally is None:
+                return
+        # Read first, so votes added during the count can only make the
+        # stored version older than what was counted, never newer.
+        version = poll_tally.version
+        results_sequence = count_tally(poll_id, poll_tally)
+        if not poll_tally.consistent():
+            # The tally lost track of its ballots, so start again from the
+            # database rather than store a miscount.
+            current_app.logger.warning(
+                "Tally for poll {0} doesn't match its version, rebuilding"
+                .format(poll_id))
+            tally.discard_tally(poll_id)
+            poll_tally = rebuild_tally(poll_id)
+            if poll_tally is None:
+                return
+            version = poll_tally.version
+            results_sequence = count_tally(poll_id, poll_tally)
+    db_funcs.update_results(poll_id, json.dumps(results_sequence), version,
+                            final)
+    live.get_publisher().wake()
+
+
+def rebuild_tally(poll_id):
+    """Load a poll's tally from the database, or None if there's no count.
+
+    The tally's version is read along with its ballots, so votes committed
+    meanwhile are neither missed nor added twice (see tally.record_votes).
+    """
+    versioned = db_funcs.get_versioned_ballots(poll_id)
+    if versioned is None:
+        return None
+    version, ballots = versioned
+    choices = [number for number, text in db_funcs.get_choices(poll_id)]
+    poll_tally = tally.load_tally(poll_id, choices, ballots, version)
+    if poll_tally.total < version:
+        # Ballots were deleted after the final count; nothing to do.
+        tally.discard_tally(poll_id)
+        return None
+    return poll_tally
+
+
+def count_tally(poll_id, poll_tally):
+    """Run a poll's count with the configured backend."""
+    return poll_tally.count(
+        seed=poll_id,
+        backend=current_app.config["TALLY_BACKEND"],
+        numpy_threshold=current_app.config["NUMPY_TALLY_THRESHOLD"])
+
+
+def finalise_poll(poll_id):
+    """Close poll, record its final results, then delete its ballots.
+
+    Does nothing if the poll was already closed, e.g. by another process.
+    """
+    if not db_funcs.close_poll(poll_id):
         return
-    # Option that has the most first-preference votes this round.
-    round_winner = max(choices, key=lambda x: votes[x])
-    # Populate 'eliminated' set with choices that already have
-    # no first-preference votes, so they don't get counted later.
-    eliminated = set(c for c in choices if votes[c] == 0)
-    # Store the first-preference votes for the first round in the results list.
-    results_sequence = [votes]
-    # Continue until there is a majority of outstanding ballots.
-    while votes[round_winner] <= total_ballots/2:
-        # Placeholder dict. Awkward to simply create this in a comprehension
-        # because any number of keys from the first dict could be related
-        # to one from the second.
-        # eg 2,1 3,1 4,1 5,1 6,1 7,1 could all collapse to the key 1.
-        new_ballots = defaultdict(lambda: 0)
-        # Find the minimum vote number for options not already eliminated.
-        # Could be any non-negative number including 0. But if we simply got
-        # the minimum then eliminated options would be the minimum every time.
-        # Voting wouldn't progress. So we keep track.
-        lowest_votes = min([c for v, c in votes.items() if v not in eliminated])
-        # 'losers': options that won the minimum number of votes.
-        losers = [c for c in choices if votes[c] == lowest_votes]
-        # Don't count eliminated options.
-        losers = set(losers) - eliminated
-        if len(losers) > 1:
-            # Multiple losers. Can we eliminate all at once?
-            # Only if the sum total of all loser votes is less than the
-            # number of votes won by the next best option.
-            second_lowest_votes = min(set(votes.values()) - set([lowest_votes]))
-            if sum([votes[l] for l in losers]) >= second_lowest_votes:
-                # It's possible that a loser might, if not eliminated now,
-                # win enough votes to beat a non-loser.
-                # We can't eliminate them all safely, so randomly tie-break.
-                losers = set(random.sample(losers, 1))
-            # 'losers' is now guaranteed to either be one candidate, or a set
-            # of candidates that can safely be eliminated simultanenously.
-        # Record the 'losers' as being eliminated, as that's what will happen.
-        eliminated |= losers
-        if eliminated == set(choices):
-            # We've eliminated everyone. It's a draw. Shut down everything.
-            db_funcs.update_results(poll_id, json.dumps(results_sequence))
-            return
-        for ballot, count in ballots.items():
-            # Excise eliminated options from the ballot.
-            new_ballot = ",".join([c for c in ballot.split(",")
-                                   if not int(c) in eliminated])
-            # Check that at least one option remains on the ballot!
-            # No point counting it if not.
-            if len(new_ballot) > 0:
-                # Add the number of votes for the old ballot to the count
-                # for the new ballot.
-                new_ballots[new_ballot] += count
-        if len(new_ballots) == 0:
-            # With tie-breaking this probably isn't possible. But if so:
-            # Every ballot consisted only of eliminated options.
-            # End voting early.
-            db_funcs.update_results(poll_id, json.dumps(results_sequence))
-            return
-        # Update the key variables, append this round's results to the list.
-        ballots = new_ballots
-        total_ballots = sum(ballots.values())
-        votes = {choice: sum([count for ballot, count in ballots.items()
-                              if ballot.split(",")[0] == str(choice)])
-                 for choice in choices}
-        round_winner = max(choices, key=lambda x: votes[x])
-        results_sequence.append(votes)
-    # Voting is finally over, a majority has been attained.
-    db_funcs.update_results(poll_id, json.dumps(results_sequence))
-    return
+    generate_results(poll_id)
+    db_funcs.delete_counted_ballots(poll_id)
+    current_app.logger.info("Closed poll {0}".format(poll_id))
+
+
+def conditional_response(render, etag, last_update, final):
+    """Return a results page response with HTTP caching headers.
+
+    Clients holding the current version get a 304 without the page being
+    rendered. Final results never change, so may be cached publicly for
+    FINAL_RESULTS_MAX_AGE; others must be revalidated every time.
+
+    Args:
+        render (callable): Returns the page's HTML.
+        etag (str): Version of the results shown.
+        last_update (int): Timestamp of the results shown.
+        final (bool): Whether the results are final.
+    """
+    if "_flashes" in session:
+        # Flashed messages are rendered into the page, so it can't be reused.
+        response = make_response(render())
+        response.cache_control.no_store = True
+        return response
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(last_update,
+                                                    timezone.utc)
+    if final:
+        response.cache_control.public = True
+        response.cache_control.max_age = (
+            current_app.config["FINAL_RESULTS_MAX_AGE"])
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @bp.route("<int:poll_id>/results")
 def get_results(poll_id):
     """View function for get poll results page."""
+    # Rendered pages of final results are kept, since they never change.
+    results_cache = cache.get_cache("results")
+    page = results_cache.get(poll_id)
+    if page is not cache.MISSING:
+        html, etag, last_update = page
+        return conditional_response(lambda: html, etag, last_update, True)
     row = db_funcs.get_poll(poll_id)
     if row is None:
         abort(404)
+    poll_open = row["open"]
+    closed = not row["open"]
+    if poll_open and row["close_date"] < datetime.now().timestamp():
+        # Poll should have been closed by now; the closer will count it.
+        closer.get_closer().close_soon(poll_id)
+        poll_open = False
     # If poll is open and early results disabled, no results are available.
-    if not row["early_results"] and row["open"]:
-        # Although it's possible that the poll should be closed now.
-        if row["close_date"] < datetime.now().timestamp():
-            db_funcs.close_poll(poll_id)
-        else:
-            # If not, send the user back whence they came.
-            flash("Preview results not available for this poll")
-            return redirect(url_for("polls.get_poll", poll_id=poll_id))
+    if not row["early_results"] and poll_open:
+        # Send the user back whence they came.
+        flash("Preview results not available for this poll")
+        return redirect(url_for("polls.get_poll", poll_id=poll_id))
     title = row["title"]
     text = row["text"]
-    poll_open = row["open"]
     row = db_funcs.get_results(poll_id)
     # Timestamp for earliest acceptable cached results.
     update_target = (int(datetime.now().timestamp())
                      - current_app.config["UPDATE_INTERVAL"])
-    if row is None or row["last_update"] < update_target:
-        # No up to date results found, so calculate some.
-        generate_results(poll_id)
-        row = db_funcs.get_results(poll_id)
+    if row is not None and row["final"]:
+        poll_open = False
+    elif closed:
+        # Closed polls only get here if their final count failed.
+        worker.get_worker().request(poll_id)
+    elif poll_open and (row is None or (
+            row["last_update"] < update_target
+            and row["votes_cast"] != db_funcs.get_number_votes_cast(poll_id))):
+        # No up to date results found, so have some calculated. Counting is
+        # left to the results worker; meanwhile show what we have.
+        worker.get_worker().request(poll_id)
+    # Overdue polls still marked open are left for the closer to count.
+    if row is None:
+        flash("Results are still being counted, check back shortly")
+        if poll_open:
+            return redirect(url_for("polls.get_poll", poll_id=poll_id))
+        else:
+            return redirect(url_for("home"))
     results = json.loads(row["results_json"])
     if sum(results[0].values()) == 0:
         if poll_open:
@@ -309,31 +405,47 @@ def get_results(poll_id):
         else:
             flash("This poll closed without any votes being cast")
             return redirect(url_for("home"))
-    rows = db_funcs.get_choices(poll_id)
     # Associate choice numbers with names/descriptions.
-    choice_dict = {row["choice_number"]: row["text"] for row in rows}
+    choice_dict = dict(db_funcs.get_choices(poll_id))
     # Let's not rely on Javascript to identify the winner of each round.
-    winners = [choice_dict[int(x)]
-               for x in [y for y in results[-1].keys()
-                         if results[-1][y] == max(results[-1].values())]]
-    return render_template("results.html", results=results,
-                           choice_dict=choice_dict,
-                           winners=winners,
-                           title=title,
-                           text=text,
-                           poll_id=poll_id,
-                           poll_open=poll_open)
-
-# DEPRECATED?
-def update_open_polls():
-    """Do housekeeping."""
-    # Close expired polls and generate results for them.
-    for poll_id in db_funcs.close_expired_polls():
-        generate_results(poll_id)
-        # TODO: Delete ballots too.
-    # Generate results for polls that are still open and preview enabled.
-    for poll_id in db_funcs.get_open_early_results_polls():
-        generate_results(poll_id)
+    winners = [choice_dict[int(x)] for x in tally.winners(results)]
+
+    def render():
+        return render_template("results.html", results=results,
+                               choice_dict=choice_dict,
+                               winners=winners,
+                               title=title,
+                               text=text,
+                               poll_id=poll_id,
+                               poll_open=poll_open)
+
+    etag = "{0}-{1}-{2}".format(poll_id, row["votes_cast"],
+                                row["last_update"])
+    if row["final"] and "_flashes" not in session:
+        html = render()
+        results_cache.set(poll_id, (html, etag, row["last_update"]))
+        return conditional_response(lambda: html, etag, row["last_update"],
+                                    True)
+    return conditional_response(render, etag, row["last_update"],
+                                bool(row["final"]))
+
+@bp.route("<int:poll_id>/results/stream")
+def stream_results(poll_id):
+    """Server-Sent Events stream of a poll's results as they change."""
+    row = db_funcs.get_poll(poll_id)
+    if row is None or (row["open"] and not row["early_results"]):
+        abort(404)
+    publisher = live.get_publisher()
+    subscriber = publisher.subscribe(poll_id)
+    if subscriber is None:
+        abort(503)
+    stream = live.event_stream(publisher, poll_id, subscriber,
+                               request.headers.get("Last-Event-ID"),
+                               current_app.config["LIVE_KEEPALIVE"])
+    return Response(stream, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             # Stop nginx from buffering the stream.
+                             "X-Accel-Buffering": "no"})
 
 @bp.route("<int:poll_id>/delete", methods=("GET", "POST"))
 def delete_poll(poll_id):
@@ -370,10 +482,8 @@ def delete_poll(poll_id):
 ##    salt = hashlib.sha1(row["title"].encode("ascii")
 ##                          + str(row["close_date"]).encode("ascii")).digest()
     salt = utils.get_poll_salt(row["title"], row["close_date"])
-    # Get hash of password+salt
-    token = utils.hash_password(form.password.data, salt)
-    # Compare given hash with known hash using safe comparison function
-    if not hmac.compare_digest(row["token"], token):
+    # Hash password+salt and compare with the stored hash.
+    if not hashing.check_password(form.password.data, salt, row["token"]):
         current_app.logger.info("Incorrect password")
         flash("Incorrect password")
         return redirect(url_for("polls.delete_poll", poll_id=poll_id))
@@ -413,12 +523,12 @@ def send_deletion_email(poll_id):
                   email_html,
                   "deletepoll@stickpoll.com",
                   row["email"])
-        flash("Email sent")
+        flash("Email on its way")
         # Success, redirect back to poll.
         return redirect(url_for("polls.get_poll", poll_id=poll_id))
     except Exception as e:
         flash("Problem sending email, administrator notified")
-        current_app.logger.error("Problem sending email: {0}".format(e))
+        current_app.logger.error("Problem queueing email: {0}".format(e))
         # Failure, redirect back to deletion page.
         return redirect(url_for("polls.delete_poll", poll_id=poll_id))
 
@@ -435,3 +545,35 @@ def send_delete_token(poll_id, token):
         current_app.logger.info("Bad token: {0}".format(token))
         flash("Bad token!")
     return redirect(url_for("home"))
+
+
+@click.command("check-tally")
+@click.option("--poll-id", type=int, default=None,
+              help="Only check this poll (default: every open poll).")
+@with_appcontext
+def check_tally_command(poll_id):
+    """Check the NumPy tally backend against the pure Python one."""
+    if tally.numpy is None:
+        raise click.ClickException("NumPy is not installed.")
+    if poll_id is None:
+        poll_ids = [row["id"] for row in db_funcs.get_open_polls()]
+    else:
+        poll_ids = [poll_id]
+    mismatches = 0
+    for poll_id in poll_ids:
+        choices = [number for number, text
+                   in db_funcs.get_choices(poll_id)]
+        poll_tally = tally.Tally(choices, db_funcs.get_ballots(poll_id))
+        expected = poll_tally.count(seed=poll_id, backend="python")
+        actual = poll_tally.count(seed=poll_id, backend="numpy")
+        if actual != expected:
+            mismatches += 1
+            click.echo("Poll {0}: backends disagree".format(poll_id))
+    click.echo("Checked {0} polls, {1} mismatches."
+               .format(len(poll_ids), mismatches))
+    if mismatches:
+        raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(check_tally_command)
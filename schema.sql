@@ -3,6 +3,8 @@ DROP TABLE IF EXISTS Choices;
 DROP TABLE IF EXISTS Ballots;
 DROP TABLE IF EXISTS Results;
 DROP TABLE IF EXISTS Cookies;
+DROP TABLE IF EXISTS Outbox;
+DROP TABLE IF EXISTS SchemaVersion;
 
 CREATE TABLE Questions (
   id INTEGER PRIMARY KEY,
@@ -12,7 +14,8 @@ CREATE TABLE Questions (
   close_date INTEGER NOT NULL,
   early_results INTEGER NOT NULL,
   email TEXT,
-  token TEXT NOT NULL
+  token TEXT NOT NULL,
+  votes_cast INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE TABLE Choices (
@@ -25,7 +28,7 @@ CREATE TABLE Choices (
 
 CREATE TABLE Ballots (
   id INTEGER PRIMARY KEY,
-  ballot_string TEXT NOT NULL,
+  ballot INTEGER NOT NULL,
   count INTEGER DEFAULT 0,
   question_id INTEGER,
   FOREIGN KEY(question_id) REFERENCES Questions(id) ON UPDATE CASCADE ON DELETE CASCADE
@@ -36,11 +39,51 @@ CREATE TABLE Results (
   question_id INTEGER,
   results_json TEXT NOT NULL,
   last_update INTEGER,
+  votes_cast INTEGER,
+  final INTEGER NOT NULL DEFAULT 0,
   FOREIGN KEY(question_id) REFERENCES Questions(id) ON UPDATE CASCADE ON DELETE CASCADE
 );
 
 CREATE TABLE Cookies (
   id INTEGER PRIMARY KEY,
   hash TEXT,
-  last_seen INTEGER
-);
\ No newline at end of file
+  last_seen INTEGER,
+  generation INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE Outbox (
+  id INTEGER PRIMARY KEY,
+  sender TEXT NOT NULL,
+  recipient TEXT NOT NULL,
+  subject TEXT NOT NULL,
+  html TEXT NOT NULL,
+  created INTEGER NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt INTEGER NOT NULL,
+  claim TEXT,
+  sent INTEGER,
+  last_error TEXT
+);
+
+CREATE UNIQUE INDEX Ballots_question_ballot ON Ballots (question_id, ballot);
+CREATE UNIQUE INDEX Results_question ON Results (question_id);
+CREATE INDEX Choices_question ON Choices (question_id, choice_number);
+CREATE INDEX Questions_open_close_date ON Questions (open, close_date);
+CREATE INDEX Questions_open_id ON Questions (open, id);
+CREATE INDEX Outbox_due ON Outbox (sent, next_attempt);
+CREATE INDEX Outbox_claim ON Outbox (claim);
+
+CREATE TABLE SchemaVersion (
+  version INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied INTEGER NOT NULL
+);
+
+INSERT INTO SchemaVersion (version, name, applied) VALUES
+  (1, 'packed_ballots', strftime('%s', 'now')),
+  (2, 'votes_cast', strftime('%s', 'now')),
+  (3, 'search_generation', strftime('%s', 'now')),
+  (4, 'hot_path_indexes', strftime('%s', 'now')),
+  (5, 'cookie_generation', strftime('%s', 'now')),
+  (6, 'outbox', strftime('%s', 'now')),
+  (7, 'final_results', strftime('%s', 'now'));
\ No newline at end of file
@@ -11,6 +11,16 @@ CREATE VIRTUAL TABLE Questions_index USING fts5 (
   close_date,
 );
 
+-- Bumped by the triggers below whenever search results could change, so
+-- cached searches from an older generation are ignored. Kept, and bumped by
+-- init_index_db, when the index is rebuilt.
+CREATE TABLE IF NOT EXISTS SearchGeneration (
+  generation INTEGER NOT NULL
+);
+
+INSERT INTO SearchGeneration (generation)
+ SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM SearchGeneration);
+
 CREATE TRIGGER after_Questions_insert
  AFTER INSERT ON Questions
  BEGIN INSERT INTO Questions_index (
@@ -26,6 +36,7 @@ CREATE TRIGGER after_Questions_insert
   new.open,
   new.close_date
 );
+ UPDATE SearchGeneration SET generation = generation + 1;
 END;
 
 CREATE TRIGGER after_Questions_update
@@ -38,10 +49,12 @@ CREATE TRIGGER after_Questions_update
    open = new.open,
    close_date = new.close_date
   WHERE rowid = old.id;
+ UPDATE SearchGeneration SET generation = generation + 1;
 END;
 
 CREATE TRIGGER after_Questions_delete
  AFTER DELETE ON Questions
  BEGIN DELETE FROM Questions_index
  WHERE rowid = old.id;
+ UPDATE SearchGeneration SET generation = generation + 1;
 END;
\ No newline at end of file
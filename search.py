@@ -1,15 +1,80 @@
 """Blueprint for search page."""
 
-from flask import Blueprint, flash, render_template, request
+import base64
+import binascii
+import json
+import math
+
+from flask import Blueprint, current_app, flash, render_template, request
 
 import bleach
 
 from apsw import SQLError
 from forms import SearchForm
+import cache
 import db_funcs
 
 bp = Blueprint("search", __name__, url_prefix="/search")
 
+def encode_cursor(after):
+    """Serialise a search_db page position for the next page link."""
+    return base64.urlsafe_b64encode(json.dumps(after).encode("utf-8")
+                                    ).decode("ascii")
+
+def decode_cursor(cursor):
+    """Read a page position from encode_cursor, or None if absent/invalid."""
+    if not cursor:
+        return None
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    if (not isinstance(after, list) or len(after) != 2
+            or not is_sql_number(after[0], (int, float))
+            or not is_sql_number(after[1], int)):
+        return None
+    return tuple(after)
+
+def is_sql_number(value, types):
+    """Return whether value is of types and can be bound as an SQLite number.
+
+    Rejects bools, which are ints, NaN and infinities, which json.loads
+    accepts, and ints out of SQLite's 64-bit range.
+    """
+    if isinstance(value, bool) or not isinstance(value, types):
+        return False
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return -2**63 <= value < 2**63
+
+def cached_search(search_string, search_open, search_columns, order_by,
+                  order_dir, cursor):
+    """Return a page of sanitised search results and the next page cursor.
+
+    Pages are cached until the search index changes (tracked by its
+    SearchGeneration counter) or SEARCH_CACHE_TTL runs out, which is what
+    bounds how stale the vote counts shown can get.
+    """
+    key = (db_funcs.get_search_generation(), search_string, search_open,
+           search_columns, order_by, order_dir, cursor)
+    search_cache = cache.get_cache("search")
+    page = search_cache.get(key)
+    if page is not cache.MISSING:
+        return page
+    search_results, next_after = db_funcs.search_db(
+        search_string, search_open, search_columns, order_by, order_dir,
+        current_app.config["SEARCH_PAGE_SIZE"], decode_cursor(cursor))
+    search_results = [dict(row) for row in search_results]
+    for row in search_results:
+        row["snippet"] = bleach.clean(row["snippet"], tags=["b"])
+    if next_after is None:
+        next_cursor = None
+    else:
+        next_cursor = encode_cursor(next_after)
+    page = (search_results, next_cursor)
+    search_cache.set(key, page)
+    return page
+
 @bp.route("/", methods=("GET", "POST"))
 def search_page():
     """View function for search page."""
@@ -22,12 +87,11 @@ def search_page():
     order_by = form.order_by.data
     order_dir = form.order_dir.data
     try:
-        search_results = db_funcs.search_db(search_string, search_open,
-                                            search_columns, order_by, order_dir)
+        search_results, next_cursor = cached_search(
+            search_string, search_open, search_columns, order_by, order_dir,
+            form.cursor.data)
     except SQLError:
         flash("Invalid query text")
         return render_template("search.html", form=form)
-    for row in search_results:
-        row["snippet"] = bleach.clean(row["snippet"], tags=["b"])
-        row["votes"] = db_funcs.get_number_votes_cast(row["rowid"])
-    return render_template("search_results.html", search_results=search_results)
+    return render_template("search_results.html", search_results=search_results,
+                           form=form, next_cursor=next_cursor)
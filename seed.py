@@ -0,0 +1,193 @@
+"""Synthetic data for load and capacity testing.
+
+`flask seed-db` bulk-loads random polls, choices, grouped ballots and
+cookies, SEED_BATCH_SIZE polls to a transaction, without going through
+db_funcs.add_poll (and its scrypt hash). Seeded polls have an empty token,
+so they can't be deleted with a password. Closed polls keep their ballots,
+to be counted by the results worker when their results are first viewed.
+
+The search index's insert trigger is dropped while loading, and the whole
+index rebuilt once at the end.
+"""
+
+from datetime import datetime
+import random
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import db
+import tally
+
+
+# Words for synthetic poll titles, questions and choices.
+VOCABULARY = ("apple banana cherry durian elder fig grape honeydew kiwi lemon "
+              "mango nectarine orange papaya quince raspberry strawberry "
+              "tangerine vanilla watermelon best worst favourite which "
+              "should would election club lunch team colour holiday film "
+              "book game music city weekend meeting project name logo").split()
+
+# How many choices each voter ranks, given the number of choices.
+DEPTHS = {
+    # Most voters rank a few choices, fewer go on to rank the rest.
+    "geometric": lambda rng, n: min(n, 1 + int(rng.expovariate(0.7))),
+    "uniform": lambda rng, n: rng.randint(1, n),
+    "short": lambda rng, n: rng.randint(1, min(3, n)),
+    "full": lambda rng, n: n,
+}
+
+
+def random_text(rng, words):
+    """Return words random words from VOCABULARY."""
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def make_ballots(rng, n_ballots, n_choices, depth, first=None):
+    """Return grouped packed ballots ranking depth(rng) choices each.
+
+    first(i) optionally fixes the first preference of the i-th ballot.
+
+    Returns:
+        dict of int keyed by int: Number of votes per packed ballot.
+    """
+    ballots = {}
+    for i in range(n_ballots):
+        length = depth(rng)
+        ranking = rng.sample(range(n_choices), length)
+        if first is not None:
+            choice = first(i)
+            ranking = [choice] + [c for c in ranking if c != choice]
+            ranking = ranking[:length]
+        ballot = tally.pack_ballot(ranking)
+        ballots[ballot] = ballots.get(ballot, 0) + 1
+    return ballots
+
+
+def seed_polls(cursor, rng, n_polls, min_choices, max_choices, mean_votes,
+               depth, open_fraction, batch_size):
+    """Insert synthetic polls with their choices and ballots.
+
+    Args:
+        cursor: Database cursor.
+        rng (random.Random): Source of all random data.
+        n_polls (int): Number of polls.
+        min_choices (int): Fewest choices in a poll.
+        max_choices (int): Most choices in a poll.
+        mean_votes (float): Mean votes per poll; exponentially distributed,
+            so most polls get a few and some a lot.
+        depth (function): Number of choices ranked on a ballot, from
+            (rng, n_choices).
+        open_fraction (float): Fraction of polls still open.
+        batch_size (int): Polls per transaction.
+
+    Returns:
+        tuple of int: Polls, choices and votes inserted.
+    """
+    now = int(datetime.now().timestamp())
+    day = 24*60*60
+    first_id = cursor.execute("SELECT coalesce(max(id), 0) + 1 "
+                              "FROM Questions").fetchall()[0][0]
+    totals = [0, 0, 0]
+    for start in range(0, n_polls, batch_size):
+        questions, choices, ballots = [], [], []
+        for poll_id in range(first_id + start,
+                             first_id + min(start + batch_size, n_polls)):
+            n_choices = rng.randint(min_choices, max_choices)
+            is_open = rng.random() < open_fraction
+            if is_open:
+                close_date = now + rng.randint(60*60, 30*day)
+            else:
+                close_date = now - rng.randint(60*60, 365*day)
+            n_votes = (int(rng.expovariate(1 / mean_votes))
+                       if mean_votes > 0 else 0)
+            grouped = make_ballots(rng, n_votes, n_choices,
+                                   lambda r: depth(r, n_choices))
+            votes_cast = sum(grouped.values())
+            questions.append((poll_id,
+                              random_text(rng, rng.randint(2, 6)).capitalize(),
+                              random_text(rng, rng.randint(5, 25)) + "?",
+                              int(is_open), close_date,
+                              int(rng.random() < 0.5), votes_cast))
+            choices += [(random_text(rng, rng.randint(1, 3)), poll_id, i)
+                        for i in range(n_choices)]
+            ballots += [(ballot, count, poll_id)
+                        for ballot, count in grouped.items()]
+            totals[1] += n_choices
+            totals[2] += votes_cast
+        cursor.execute("BEGIN")
+        cursor.executemany("INSERT INTO Questions (id, title, text, open, "
+                           "close_date, early_results, token, votes_cast) "
+                           "VALUES (?, ?, ?, ?, ?, ?, '', ?)", questions)
+        cursor.executemany("INSERT INTO Choices (text, question_id, "
+                           "choice_number) VALUES (?, ?, ?)", choices)
+        cursor.executemany("INSERT INTO Ballots (ballot, count, question_id) "
+                           "VALUES (?, ?, ?)", ballots)
+        cursor.execute("COMMIT")
+        totals[0] += len(questions)
+        click.echo("Seeded {0} of {1} polls.".format(totals[0], n_polls))
+    return tuple(totals)
+
+
+def seed_cookies(cursor, rng, n_cookies, batch_size):
+    """Insert cookies last seen within the COOKIE_RETENTION period."""
+    now = int(datetime.now().timestamp())
+    retention = current_app.config["COOKIE_RETENTION"]
+    for start in range(0, n_cookies, batch_size):
+        count = min(batch_size, n_cookies - start)
+        cursor.execute("BEGIN")
+        cursor.executemany("INSERT INTO Cookies (hash, last_seen) "
+                           "VALUES (?, ?)",
+                           [("{0:064x}".format(rng.getrandbits(256)),
+                             now - rng.randint(0, retention))
+                            for _ in range(count)])
+        cursor.execute("COMMIT")
+    return n_cookies
+
+
+@click.command("seed-db")
+@click.option("--polls", "n_polls", type=int, default=10000,
+              help="Number of polls.")
+@click.option("--min-choices", type=int, default=2,
+              help="Fewest choices in a poll.")
+@click.option("--max-choices", type=int, default=8,
+              help="Most choices in a poll.")
+@click.option("--votes", "mean_votes", type=float, default=50,
+              help="Mean votes per poll.")
+@click.option("--depth", type=click.Choice(sorted(DEPTHS)),
+              default="geometric",
+              help="How many choices voters rank.")
+@click.option("--open-fraction", type=float, default=0.5,
+              help="Fraction of polls still open.")
+@click.option("--cookies", "n_cookies", type=int, default=10000,
+              help="Number of cookies.")
+@click.option("--seed", type=int, default=None, help="Random seed.")
+@with_appcontext
+def seed_db_command(n_polls, min_choices, max_choices, mean_votes, depth,
+                    open_fraction, n_cookies, seed):
+    """Bulk-load synthetic polls, ballots and cookies."""
+    if not 2 <= min_choices <= max_choices <= tally.MAX_CHOICES:
+        raise click.BadParameter("Choices must be between 2 and {0}"
+                                 .format(tally.MAX_CHOICES))
+    if not 0 <= open_fraction <= 1:
+        raise click.BadParameter("Open fraction must be between 0 and 1")
+    rng = random.Random(seed)
+    batch_size = current_app.config["SEED_BATCH_SIZE"]
+    cursor = db.get_db(raw=True)
+    # Indexing every row as it goes in is far slower than rebuilding.
+    cursor.execute("DROP TRIGGER IF EXISTS after_Questions_insert")
+    try:
+        polls, choices, votes = seed_polls(cursor, rng, n_polls, min_choices,
+                                           max_choices, mean_votes,
+                                           DEPTHS[depth], open_fraction,
+                                           batch_size)
+        cookies = seed_cookies(cursor, rng, n_cookies, batch_size)
+    finally:
+        click.echo("Rebuilding search index.")
+        db.init_index_db()
+    click.echo("Seeded {0} polls, {1} choices, {2} votes and {3} cookies."
+               .format(polls, choices, votes, cookies))
+
+
+def init_app(app):
+    app.cli.add_command(seed_db_command)
@@ -0,0 +1,214 @@
+"""Log of slow database statements and their query plans.
+
+Statements taking longer than SLOW_QUERY_THRESHOLD seconds (see
+db.instrument) are written to SLOW_QUERY_LOG as JSON lines, with their
+normalised SQL, the types of their bound parameters and their run time.
+The statement can't be explained while it's running, so EXPLAIN QUERY PLAN
+is put off until the app context is torn down. Each distinct plan is only
+written out in full the first time this process sees it; later entries
+just refer to it by id.
+
+`flask slow-queries` reports the log grouped by normalised SQL.
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import apsw
+import click
+from flask import current_app, g, has_app_context
+from flask.cli import with_appcontext
+
+import db
+import logs
+
+SQLITE_TYPES = {type(None): "null", int: "int", float: "float", str: "text",
+                bytes: "blob"}
+# Statements without a query plan, or that can't be explained after the
+# fact (e.g. CREATE TABLE, once the table exists).
+UNPLANNED = {"", "BEGIN", "COMMIT", "END", "ROLLBACK", "SAVEPOINT", "RELEASE",
+             "PRAGMA", "CREATE", "DROP", "ALTER", "ATTACH", "DETACH",
+             "VACUUM", "ANALYZE", "REINDEX"}
+
+
+def normalise_sql(statement):
+    """Return statement with literals and whitespace made uniform."""
+    statement = re.sub(r"\?\d+", "?", statement)
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+(?:\.\d+)?\b", "?", statement)
+    # Lists of any length, e.g. for IN, group together.
+    statement = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", statement)
+    return " ".join(statement.split()).rstrip(";")
+
+
+def binding_shapes(bindings):
+    """Return the SQLite types of bound parameters, not their values."""
+    if bindings is None:
+        return None
+    if isinstance(bindings, dict):
+        return {name: SQLITE_TYPES.get(type(value), type(value).__name__)
+                for name, value in bindings.items()}
+    return [SQLITE_TYPES.get(type(value), type(value).__name__)
+            for value in bindings]
+
+
+def explain(statement, bindings):
+    """Return EXPLAIN QUERY PLAN output as indented lines, or None.
+
+    statement is a single statement with its own bindings, as traced; apsw
+    traces each statement of a multi-statement string separately. Those
+    with no plan, like COMMIT, return None.
+    """
+    verb = re.match(r"\s*(\w*)", statement).group(1).upper()
+    if verb in UNPLANNED:
+        return None
+    try:
+        rows = list(db.get_db(raw=True).execute(
+            "EXPLAIN QUERY PLAN " + statement.strip().rstrip(";"), bindings))
+    except apsw.Error as e:
+        current_app.logger.warning("Couldn't explain slow query: {0}: {1}"
+                                   .format(e, normalise_sql(statement)))
+        return None
+    depths = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depths[node_id] = depths.get(parent, -1) + 1
+        lines.append("  "*depths[node_id] + detail)
+    return lines or None
+
+
+class SlowQueryLog:
+    """Collects slow statements and writes them out with their plans."""
+
+    def __init__(self, app):
+        self.app = app
+        self.threshold = app.config["SLOW_QUERY_THRESHOLD"]
+        self.seen_plans = set()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("stickpoll.slow_queries")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        logs.add_background_handlers(app, self.logger, [
+            logs.rotating_file_handler(app, app.config["SLOW_QUERY_LOG"],
+                                       logging.Formatter("%(message)s"))])
+
+    def observe(self, statement, bindings, seconds):
+        """Query observer noting statements over the threshold."""
+        if seconds < self.threshold or statement.startswith("EXPLAIN"):
+            return
+        entry = (statement, bindings, seconds, int(time.time()))
+        if has_app_context():
+            g.setdefault("slow_queries", []).append(entry)
+        else:
+            self.write(entry, None)
+
+    def flush(self, e=None):
+        """Explain and write out the app context's slow statements."""
+        for entry in g.pop("slow_queries", ()):
+            statement, bindings = entry[:2]
+            self.write(entry, explain(statement, bindings))
+
+    def write(self, entry, plan):
+        statement, bindings, seconds, timestamp = entry
+        sql = normalise_sql(statement)
+        record = {"time": timestamp, "duration": seconds, "sql": sql,
+                  "params": binding_shapes(bindings), "plan_id": None}
+        if plan is not None:
+            plan_id = hashlib.sha1("\n".join([sql] + plan).encode("utf-8")
+                                   ).hexdigest()[:12]
+            record["plan_id"] = plan_id
+            with self.lock:
+                if plan_id not in self.seen_plans:
+                    self.seen_plans.add(plan_id)
+                    record["plan"] = plan
+        self.logger.info(json.dumps(record))
+        self.app.logger.info("Slow query took {0:.0f} ms: {1}"
+                             .format(seconds*1000, sql))
+
+
+def read_log(path):
+    """Yield records from the slow query log and its backups, oldest first."""
+    paths = [path]
+    i = 1
+    while os.path.exists("{0}.{1}".format(path, i)):
+        paths.insert(0, "{0}.{1}".format(path, i))
+        i += 1
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+@click.command("slow-queries")
+@click.option("--top", type=int, default=20,
+              help="Number of statements to show.")
+@click.option("--since", type=float, default=None,
+              help="Only include the last this many hours.")
+@with_appcontext
+def slow_queries_command(top, since):
+    """Report slow statements, slowest in total first."""
+    cutoff = 0 if since is None else time.time() - since*60*60
+    groups = {}
+    plans = {}
+    for record in read_log(current_app.config["SLOW_QUERY_LOG"]):
+        if "plan" in record:
+            plans[record["plan_id"]] = record["plan"]
+        if record["time"] < cutoff:
+            continue
+        group = groups.setdefault(record["sql"], {
+            "count": 0, "total": 0.0, "max": 0.0, "last": 0,
+            "params": [], "plan_ids": []})
+        group["count"] += 1
+        group["total"] += record["duration"]
+        group["max"] = max(group["max"], record["duration"])
+        group["last"] = max(group["last"], record["time"])
+        if record["params"] not in group["params"]:
+            group["params"].append(record["params"])
+        if record["plan_id"] not in group["plan_ids"]:
+            group["plan_ids"].append(record["plan_id"])
+    if not groups:
+        click.echo("No slow queries logged.")
+        return
+    ranked = sorted(groups.items(), key=lambda item: item[1]["total"],
+                    reverse=True)
+    for sql, group in ranked[:top]:
+        click.echo("{0} x, {1:.1f} ms total, {2:.1f} ms mean, {3:.1f} ms max, "
+                   "last {4}".format(
+                       group["count"], group["total"]*1000,
+                       group["total"]*1000 / group["count"],
+                       group["max"]*1000,
+                       datetime.fromtimestamp(group["last"])
+                       .strftime("%Y-%m-%d %H:%M:%S")))
+        click.echo("  " + sql)
+        for params in group["params"]:
+            click.echo("  params: {0}".format(json.dumps(params)))
+        for plan_id in group["plan_ids"]:
+            if plan_id is None:
+                continue
+            click.echo("  plan {0}:".format(plan_id))
+            for line in plans.get(plan_id, ["(not in log)"]):
+                click.echo("    " + line)
+        click.echo()
+
+
+def init_app(app):
+    app.cli.add_command(slow_queries_command)
+    if not app.config["SLOW_QUERY_THRESHOLD"]:
+        return
+    slow_query_log = SlowQueryLog(app)
+    app.extensions["slow_query_log"] = slow_query_log
+    app.extensions.setdefault("query_observers", []).append(
+        slow_query_log.observe)
+    # Registered after db.init_app, so this runs before close_db.
+    app.teardown_appcontext(slow_query_log.flush)
@@ -0,0 +1,325 @@
+"""Instant runoff tally engine.
+
+Ballots are kept grouped (identical rankings share a single count) along with
+running first-preference totals, so a recount only has to replay the
+elimination rounds rather than re-parse every ballot row.
+"""
+
+from collections import defaultdict, OrderedDict
+import random
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How many polls' tallies to keep in memory per process.
+MAX_TALLIES = 256
+
+# Distinct ballots needed before the NumPy backend is used, when available.
+NUMPY_THRESHOLD = 50000
+
+# Packed ballot layout, see pack_ballot.
+MAX_CHOICES = 12
+BITS_PER_CHOICE = 4
+CHOICE_MASK = (1 << BITS_PER_CHOICE) - 1
+
+
+def pack_ballot(ranking):
+    """Pack a ranking of choice numbers into a single integer.
+
+    Each preference takes four bits, first preference in the lowest bits,
+    stored as choice number + 1 so that zero marks the end of the ranking.
+    Twelve choices fit in 48 bits.
+
+    Args:
+        ranking (list of int): Choice numbers, most preferred first.
+
+    Returns:
+        int: Packed ballot.
+    """
+    if not 0 < len(ranking) <= MAX_CHOICES:
+        raise ValueError("Ballot must rank between 1 and {0} choices"
+                         .format(MAX_CHOICES))
+    packed = 0
+    for i, choice in enumerate(ranking):
+        if not 0 <= choice < MAX_CHOICES:
+            raise ValueError("Invalid choice number: {0}".format(choice))
+        packed |= (choice + 1) << (BITS_PER_CHOICE * i)
+    return packed
+
+
+def unpack_ballot(packed):
+    """Return the list of choice numbers in a packed ballot."""
+    ranking = []
+    while packed:
+        ranking.append((packed & CHOICE_MASK) - 1)
+        packed >>= BITS_PER_CHOICE
+    return ranking
+
+
+def run_rounds(choices, votes, total_ballots, next_round, seed):
+    """Run IRV elimination rounds and return the sequence of round results.
+
+    Args:
+        choices (list of int): Sorted choice numbers for the poll.
+        votes (dict of int keyed by int): First-preference votes per choice.
+        total_ballots (int): Number of ballots counted in the first round.
+        next_round (callable): Called with the set of eliminated choices,
+            returns (votes, total_ballots) counting each ballot for its
+            highest ranked choice not yet eliminated.
+        seed (int): Seed for tie-breaking, normally the poll id.
+
+    Returns:
+        (list of dict): Votes per choice for each round.
+    """
+    # Seeded RNG for consistent tie-breaking.
+    rng = random.Random(seed)
+    results_sequence = [votes]
+    if total_ballots == 0:
+        # We have no votes! End early.
+        return results_sequence
+    # Option that has the most first-preference votes this round.
+    round_winner = max(choices, key=lambda x: votes[x])
+    # Choices that already have no first-preference votes are eliminated
+    # up front, so they don't get counted later.
+    eliminated = set(c for c in choices if votes[c] == 0)
+    # Continue until there is a majority of outstanding ballots.
+    while votes[round_winner] <= total_ballots/2:
+        # Lowest vote count among options not already eliminated.
+        lowest_votes = min([c for v, c in votes.items() if v not in eliminated])
+        losers = set([c for c in choices if votes[c] == lowest_votes])
+        losers = losers - eliminated
+        if len(losers) > 1:
+            # Multiple losers. We can only eliminate all at once if together
+            # they can't catch up with the next best option.
+            second_lowest_votes = min(set(votes.values()) - set([lowest_votes]),
+                                      default=0)
+            if sum([votes[l] for l in losers]) >= second_lowest_votes:
+                # Not safe to eliminate them all, so randomly tie-break.
+                losers = set(rng.sample(tuple(losers), 1))
+        eliminated |= losers
+        if eliminated == set(choices):
+            # We've eliminated everyone. It's a draw.
+            return results_sequence
+        votes, total_ballots = next_round(eliminated)
+        if total_ballots == 0:
+            # Every ballot consisted only of eliminated options.
+            return results_sequence
+        round_winner = max(choices, key=lambda x: votes[x])
+        results_sequence.append(votes)
+    # Voting is finally over, a majority has been attained.
+    return results_sequence
+
+
+def winners(results_sequence):
+    """Return the choices with the most votes in a count's last round.
+
+    Args:
+        results_sequence (list of dict): Votes per choice for each round,
+            as returned by Tally.count, or loaded from its JSON.
+
+    Returns:
+        list: Keys of the winning choices; more than one for a draw.
+    """
+    last_round = results_sequence[-1]
+    most = max(last_round.values())
+    return [choice for choice, votes in last_round.items() if votes == most]
+
+
+class Tally:
+    """Grouped ballots and running first-preference counts for one poll."""
+
+    def __init__(self, choices, ballots=None, version=None):
+        """Build a tally from choice numbers and a dict of ballot counts.
+
+        Args:
+            choices (list of int): Choice numbers for the poll.
+            ballots (dict of int keyed by int): Number of votes for each
+                packed ballot, as returned by db_funcs.get_ballots.
+            version (int): The poll's votes_cast when ballots were read;
+                defaults to the number of ballots.
+        """
+        self.choices = sorted(choices)
+        self.ballots = defaultdict(int)
+        self.first_prefs = {choice: 0 for choice in self.choices}
+        self.total = 0
+        self.lock = threading.Lock()
+        if ballots is not None:
+            for ballot, count in ballots.items():
+                self._add(ballot, count)
+        self.version = self.total if version is None else version
+
+    def _add(self, ballot, count):
+        self.ballots[ballot] += count
+        first = (ballot & CHOICE_MASK) - 1
+        if first in self.first_prefs:
+            self.first_prefs[first] += count
+        self.total += count
+
+    def add_votes(self, ballots, version):
+        """Record newly stored votes, if this tally is just before them.
+
+        Args:
+            ballots (dict of int keyed by int): Votes per packed ballot,
+                stored in one transaction.
+            version (int): The poll's votes_cast once they were stored.
+
+        Returns:
+            bool: False if the tally already has them (it was rebuilt since
+                they were committed) or is missing others, and was left
+                unchanged.
+        """
+        with self.lock:
+            if self.version != version - sum(ballots.values()):
+                return False
+            for ballot, count in ballots.items():
+                self._add(ballot, count)
+            self.version = version
+            return True
+
+    def consistent(self):
+        """Return whether the tally holds as many votes as its version."""
+        with self.lock:
+            return self.total == self.version
+
+    def count(self, seed, backend="auto", numpy_threshold=NUMPY_THRESHOLD):
+        """Run the IRV count and return the sequence of round results.
+
+        Args:
+            seed (int): Seed for tie-breaking, normally the poll id.
+            backend (str): Counting backend (auto/python/numpy). The pure
+                Python backend is the reference implementation; auto picks
+                NumPy when it's installed and there are enough ballots.
+            numpy_threshold (int): Distinct ballots needed for auto to
+                pick NumPy.
+        """
+        with self.lock:
+            ballots = dict(self.ballots)
+            votes = dict(self.first_prefs)
+            total = self.total
+        if backend == "auto":
+            if numpy is not None and len(ballots) >= numpy_threshold:
+                backend = "numpy"
+            else:
+                backend = "python"
+        if backend == "numpy":
+            next_round = self._numpy_rounds(ballots)
+        else:
+            next_round = self._python_rounds(ballots)
+        return run_rounds(self.choices, votes, total, next_round, seed)
+
+    def _python_rounds(self, ballots):
+        """Return a next_round function counting packed ballots in Python."""
+        state = {"ballots": ballots}
+
+        def next_round(eliminated):
+            # Eliminated choices as a bitmask indexed by choice number.
+            mask = 0
+            for choice in eliminated:
+                mask |= 1 << choice
+            # Shift eliminated options off the front of each ballot, merging
+            # ballots which collapse together and dropping exhausted ones.
+            # Eliminated options further down are skipped when they surface.
+            new_ballots = defaultdict(int)
+            round_votes = {choice: 0 for choice in self.choices}
+            for ballot, count in state["ballots"].items():
+                while ballot and (mask >> ((ballot & CHOICE_MASK) - 1)) & 1:
+                    ballot >>= BITS_PER_CHOICE
+                if ballot:
+                    new_ballots[ballot] += count
+                    first = (ballot & CHOICE_MASK) - 1
+                    if first in round_votes:
+                        round_votes[first] += count
+            state["ballots"] = new_ballots
+            return round_votes, sum(new_ballots.values())
+
+        return next_round
+
+    def _numpy_rounds(self, ballots):
+        """Return a next_round function counting ballots with NumPy.
+
+        Ballots become an (n_ballots x 12) int8 matrix of choice numbers,
+        padded with -1, alongside a vector of their vote counts.
+        """
+        prefs = numpy.full((len(ballots), MAX_CHOICES), -1, dtype=numpy.int8)
+        counts = numpy.empty(len(ballots), dtype=numpy.int64)
+        for i, (ballot, count) in enumerate(ballots.items()):
+            ranking = unpack_ballot(ballot)
+            prefs[i, :len(ranking)] = ranking
+            counts[i] = count
+        state = {"prefs": prefs, "counts": counts}
+
+        def next_round(eliminated):
+            prefs, counts = state["prefs"], state["counts"]
+            # Lookup indexed by choice number + 1, so padding is never live.
+            dead = numpy.zeros(MAX_CHOICES + 1, dtype=bool)
+            dead[0] = True
+            dead[[c + 1 for c in eliminated]] = True
+            live = ~dead[prefs.astype(numpy.intp) + 1]
+            # Drop exhausted ballots so later rounds have less to scan.
+            remaining = live.any(axis=1)
+            prefs, counts, live = prefs[remaining], counts[remaining], live[remaining]
+            state["prefs"], state["counts"] = prefs, counts
+            firsts = prefs[numpy.arange(len(prefs)), live.argmax(axis=1)]
+            totals = numpy.bincount(firsts, weights=counts,
+                                    minlength=MAX_CHOICES)
+            round_votes = {choice: int(totals[choice])
+                           for choice in self.choices}
+            return round_votes, int(counts.sum())
+
+        return next_round
+
+
+_tallies = OrderedDict()
+_tallies_lock = threading.Lock()
+
+
+def get_tally(poll_id):
+    """Return the in-memory tally for a poll, or None if not loaded."""
+    with _tallies_lock:
+        tally = _tallies.get(poll_id)
+        if tally is not None:
+            _tallies.move_to_end(poll_id)
+        return tally
+
+
+def load_tally(poll_id, choices, ballots, version=None):
+    """Build a fresh tally for a poll from database rows and keep it.
+
+    version is the poll's votes_cast, read in the same transaction as the
+    ballots.
+    """
+    tally = Tally(choices, ballots, version)
+    with _tallies_lock:
+        _tallies[poll_id] = tally
+        _tallies.move_to_end(poll_id)
+        while len(_tallies) > MAX_TALLIES:
+            _tallies.popitem(last=False)
+    return tally
+
+
+def record_votes(poll_id, ballots, version):
+    """Add newly stored ballots to the poll's tally, if loaded.
+
+    The tally may have been rebuilt from the database between the votes'
+    COMMIT and this call, or have missed votes stored by another process,
+    so they're only added to a tally at the version just before them (see
+    Tally.add_votes). A tally left behind is rebuilt by the next count,
+    since its version no longer matches the poll's votes_cast.
+
+    Args:
+        poll_id (int): Poll the votes are for.
+        ballots (dict of int keyed by int): Votes per packed ballot.
+        version (int): The poll's votes_cast once they were stored.
+    """
+    tally = get_tally(poll_id)
+    if tally is not None:
+        tally.add_votes(ballots, version)
+
+
+def discard_tally(poll_id):
+    """Forget the in-memory tally for a poll."""
+    with _tallies_lock:
+        _tallies.pop(poll_id, None)
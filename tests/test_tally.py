@@ -0,0 +1,154 @@
+"""Tests for the tally engine: its backends, and the tally kept up to date
+alongside stored votes.
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from app import app
+import db
+import db_funcs
+import polls
+import tally
+from tally_parity import baseline_count, random_poll
+
+
+class TallyTestCase(unittest.TestCase):
+    """Runs each test in an app context on a throwaway database."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="stickpoll-test-")
+        self.config = dict(app.config)
+        app.config.update(DATABASE=os.path.join(self.directory,
+                                                "test.sqlite"),
+                          TESTING=True, RESULTS_WORKER="external",
+                          POLL_CLOSER="external", MAIL_SENDER="external",
+                          MAIL_TRANSPORT="memory", VOTE_INGEST="direct",
+                          TALLY_BACKEND="python")
+        self.context = app.app_context()
+        self.context.push()
+        db.init_db()
+        self.poll_id = self.insert_poll(3)
+
+    def tearDown(self):
+        tally.discard_tally(self.poll_id)
+        self.context.pop()
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def insert_poll(self, n_choices):
+        cursor = db.get_db(raw=True)
+        close_date = datetime.now() + timedelta(days=1)
+        rows = list(cursor.execute(
+            "INSERT INTO Questions (title, text, open, close_date, "
+            "early_results, token) VALUES ('Test poll', 'Which?', 1, ?, 1, "
+            "''); SELECT last_insert_rowid()",
+            (int(close_date.timestamp()),)))
+        poll_id = rows[0][0]
+        cursor.executemany("INSERT INTO Choices (text, question_id, "
+                           "choice_number) VALUES (?, ?, ?)",
+                           [(str(i), poll_id, i) for i in range(n_choices)])
+        return poll_id
+
+    def stored_votes(self):
+        """Return votes in the stored first round, and the stored version."""
+        row = db_funcs.get_results(self.poll_id)
+        first_round = json.loads(row["results_json"])[0]
+        return sum(first_round.values()), row["votes_cast"]
+
+    def recount_before_record(self):
+        """Patch record_votes to recount the poll before it runs.
+
+        This is the results worker rebuilding the tally from the database
+        between a vote's COMMIT and the vote being added to the tally.
+        """
+        record_votes = tally.record_votes
+
+        def recount_then_record(poll_id, ballots, version):
+            tally.discard_tally(poll_id)
+            polls.generate_results(poll_id)
+            record_votes(poll_id, ballots, version)
+
+        return mock.patch("tally.record_votes", recount_then_record)
+
+    def test_rebuild_between_commit_and_record_vote(self):
+        db_funcs.add_vote(self.poll_id, tally.pack_ballot([0, 1]))
+        polls.generate_results(self.poll_id)
+        with self.recount_before_record():
+            db_funcs.add_vote(self.poll_id, tally.pack_ballot([1, 0]))
+        poll_tally = tally.get_tally(self.poll_id)
+        self.assertEqual(poll_tally.total, 2)
+        self.assertEqual(poll_tally.version, 2)
+        self.assertEqual(self.stored_votes(), (2, 2))
+        # A later vote still goes into the reused tally.
+        db_funcs.add_vote(self.poll_id, tally.pack_ballot([2]))
+        polls.generate_results(self.poll_id)
+        self.assertIs(tally.get_tally(self.poll_id), poll_tally)
+        self.assertEqual(self.stored_votes(), (3, 3))
+
+    def test_rebuild_between_commit_and_record_votes(self):
+        ballot = tally.pack_ballot([2, 0])
+        with self.recount_before_record():
+            db_funcs.add_votes([(self.poll_id, ballot, 1, "hash", None, 0)]*3)
+        self.assertEqual(tally.get_tally(self.poll_id).total, 3)
+        self.assertEqual(self.stored_votes(), (3, 3))
+
+    def test_missed_votes_leave_tally_to_be_rebuilt(self):
+        polls.generate_results(self.poll_id)
+        poll_tally = tally.get_tally(self.poll_id)
+        # Another process stores a vote this one never hears about.
+        with mock.patch("tally.record_votes"):
+            db_funcs.add_vote(self.poll_id, tally.pack_ballot([0]))
+        db_funcs.add_vote(self.poll_id, tally.pack_ballot([1]))
+        self.assertEqual(poll_tally.version, 0)
+        polls.generate_results(self.poll_id)
+        self.assertIsNot(tally.get_tally(self.poll_id), poll_tally)
+        self.assertEqual(self.stored_votes(), (2, 2))
+
+
+class BackendParityTestCase(unittest.TestCase):
+    """The tally backends must agree with each other on random polls."""
+
+    def check_polls(self, trials, max_ballots, seed):
+        rng = random.Random(seed)
+        for trial in range(trials):
+            choices, ballots = random_poll(rng, max_ballots)
+            poll_tally = tally.Tally(choices, ballots)
+            expected = poll_tally.count(seed=trial, backend="python")
+            with self.subTest(trial=trial, choices=choices, ballots=ballots):
+                self.assertEqual(
+                    poll_tally.count(seed=trial, backend="numpy"), expected)
+
+    def test_python_matches_original_count(self):
+        rng = random.Random(1)
+        for trial in range(500):
+            choices, ballots = random_poll(rng, 60)
+            strings = {",".join(str(c) for c in tally.unpack_ballot(ballot)):
+                       count for ballot, count in ballots.items()}
+            with self.subTest(trial=trial, choices=choices, ballots=ballots):
+                self.assertEqual(
+                    tally.Tally(choices, ballots).count(seed=trial,
+                                                        backend="python"),
+                    baseline_count(choices, strings, trial))
+
+    @unittest.skipIf(tally.numpy is None, "NumPy isn't installed")
+    def test_numpy_matches_python_on_small_polls(self):
+        # Few ballots, so ties and exhausted ballots come up often.
+        self.check_polls(1000, 60, seed=2)
+
+    @unittest.skipIf(tally.numpy is None, "NumPy isn't installed")
+    def test_numpy_matches_python_on_large_polls(self):
+        self.check_polls(50, 5000, seed=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
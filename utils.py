@@ -33,57 +33,127 @@ def get_poll_salt(title, close_date):
                           + b"-"
                           + str(close_date).encode("utf-8")).digest()
 
-def hash_password(password, salt):
-    """Return scrypt hash of password/salt."""
+def hash_password(password, salt, n=2**15, r=8, p=1):
+    """Return scrypt hash of password/salt.
+
+    Runs in hashing's worker processes; see hashing.hash_password for
+    the stored format.
+    """
     # scrypt parameters from https://blog.filippo.io/the-scrypt-parameters/
+    # scrypt needs 128 * n * r bytes, so leave room for tuning upwards.
     bin_hash = hashlib.scrypt(password.encode("utf-8"), salt=salt,
-                              n=2**15, r=8, p=1, maxmem=2**26)
+                              n=n, r=r, p=p, maxmem=max(2**26, 256*n*r))
     return binascii.hexlify(bin_hash).decode("ascii")
 
-def create_token(op_type, poll_id, expires=60*24*2):
-    """Create signed token encoding op type, poll id and expiry date."""
+def get_secret_key():
+    """Return app secret key as bytes for signing tokens."""
     try:
-        key = current_app.config["SECRET_KEY"].encode("ascii")
+        return current_app.config["SECRET_KEY"].encode("ascii")
     except AttributeError:
-        key = current_app.config["SECRET_KEY"]
-    json_serial = json.dumps({"op": op_type, "id": poll_id,
-                              "exp": int((datetime.now()
-                                          + timedelta(minutes=expires)
-                                          ).timestamp())}).encode("ascii")
-    tag = hmac.new(key, json_serial, digestmod="sha1").digest()
+        return current_app.config["SECRET_KEY"]
+
+def sign(contents, digestmod="sha1"):
+    """Serialise dict and sign it, returning a URL-safe token."""
+    json_serial = json.dumps(contents).encode("ascii")
+    tag = hmac.new(get_secret_key(), json_serial, digestmod=digestmod).digest()
     return (base64.urlsafe_b64encode(json_serial)
             + b"."
             + base64.urlsafe_b64encode(tag)).decode("ascii")
 
-def read_token(token):
-    """Verify token signature valid and return contents."""
-    try:
-        key = current_app.config["SECRET_KEY"].encode("ascii")
-    except AttributeError:
-        key = current_app.config["SECRET_KEY"]
+def unsign(token, digestmod="sha1"):
+    """Verify token from sign() and return its contents.
+
+    Raises:
+        ValueError: If the token is malformed or its signature is wrong.
+    """
     json_serial, tag = [base64.urlsafe_b64decode(s) for s in token.split(".")]
-    correct_tag = hmac.new(key, json_serial, digestmod="sha1").digest()
+    correct_tag = hmac.new(get_secret_key(), json_serial,
+                           digestmod=digestmod).digest()
     if not hmac.compare_digest(correct_tag, tag):
         raise ValueError
+    return json.loads(json_serial.decode("ascii"))
+
+def create_token(op_type, poll_id, expires=60*24*2):
+    """Create signed token encoding op type, poll id and expiry date."""
+    return sign({"op": op_type, "id": poll_id,
+                 "exp": int((datetime.now()
+                             + timedelta(minutes=expires)).timestamp())})
+
+def read_token(token):
+    """Verify token signature valid and return contents."""
+    json_dict = unsign(token)
+    if json_dict["exp"] < datetime.now().timestamp():
+        raise ValueError
     else:
-        json_dict = json.loads(json_serial.decode("ascii"))
-        if json_dict["exp"] < datetime.now().timestamp():
-            raise ValueError
-        else:
-            return json_dict
+        return json_dict
+
+def create_session_token(cookie_id, generation):
+    """Create signed token for a session's cookie id and generation.
+
+    The token records when it was issued, so valid_session can tell when
+    it's due to be checked against the database again.
+    """
+    return sign({"op": "session", "id": cookie_id, "gen": generation,
+                 "ts": int(datetime.now().timestamp())},
+                digestmod="sha256")
 
 def valid_session(session):
-    """Inspect Flask session for intact voting record data."""
+    """Inspect Flask session for intact voting record data.
+
+    With SESSION_MODE = "signed" the session carries a signed token naming
+    its cookie id and generation, and is trusted without a database lookup
+    until the token is SESSION_RECHECK_INTERVAL seconds old. Votes still
+    advance the generation in the database (see db_funcs.rotate_cookie),
+    so a replayed older session can't vote. With SESSION_MODE = "db" the
+    session's cookie hash is checked against the database every time.
+    """
     if "id" not in session or not isinstance(session["id"], int):
         return False
     if "votes" not in session or not isinstance(session["votes"], list):
         return False
+    if current_app.config["SESSION_MODE"] == "signed":
+        return valid_signed_session(session)
     if "cookie_hash" not in session or not isinstance(session["cookie_hash"],
                                                       str):
         return False
-    cookie_hash = db_funcs.get_cookie_hash(session["id"])
-    if cookie_hash is None:
+    cookie = db_funcs.get_cookie(session["id"])
+    if cookie is None:
+        return False
+    if cookie["hash"] != session["cookie_hash"]:
+        return False
+    touch_cookie(session["id"], cookie["last_seen"])
+    return True
+
+def touch_cookie(cookie_id, last_seen):
+    """Keep an active cookie's last_seen from aging into a retention purge.
+
+    Only writes once per COOKIE_TOUCH_INTERVAL, not on every request.
+    """
+    now = int(datetime.now().timestamp())
+    if (last_seen or 0) < now - current_app.config["COOKIE_TOUCH_INTERVAL"]:
+        db_funcs.touch_cookie(cookie_id, now)
+
+def valid_signed_session(session):
+    """Check the session's signed token, see valid_session."""
+    if not isinstance(session.get("session_token"), str):
         return False
-    if cookie_hash != session["cookie_hash"]:
+    try:
+        token = unsign(session["session_token"], digestmod="sha256")
+    except (ValueError, TypeError):
+        return False
+    if token.get("op") != "session" or token.get("id") != session["id"]:
         return False
+    age = datetime.now().timestamp() - token["ts"]
+    if age > current_app.config["SESSION_RECHECK_INTERVAL"]:
+        # Check the cookie hasn't been revoked or moved on since.
+        cookie = db_funcs.get_cookie(session["id"])
+        if cookie is None or cookie["generation"] != token["gen"]:
+            return False
+        touch_cookie(session["id"], cookie["last_seen"])
+        session["session_token"] = create_session_token(session["id"],
+                                                        token["gen"])
     return True
+
+def get_session_generation(session):
+    """Return cookie generation from a session passing valid_session."""
+    return unsign(session["session_token"], digestmod="sha256")["gen"]
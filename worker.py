@@ -0,0 +1,122 @@
+"""Background recounting of poll results.
+
+Views never count votes themselves; they ask the results worker for a
+recount and read whatever is stored in Results. The worker runs either as a
+thread inside the web process (RESULTS_WORKER = "thread") or as a separate
+`flask results-worker` process (RESULTS_WORKER = "external"), in which case
+requests from views are ignored and it instead sweeps every UPDATE_INTERVAL
+seconds for open early-results polls with new votes and closed polls
+without final results.
+"""
+
+import queue
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import db_funcs
+
+
+class ResultsWorker:
+    """Queue of polls awaiting a recount, with at most one entry per poll."""
+
+    def __init__(self, app, recount):
+        """Create worker for app, recounting polls with recount(poll_id)."""
+        self.app = app
+        self.recount = recount
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def request(self, poll_id):
+        """Queue a recount for poll, if the worker runs in this process.
+
+        An external worker finds the poll on its next sweep instead.
+        """
+        if self.app.config["RESULTS_WORKER"] != "thread":
+            return
+        self.enqueue(poll_id)
+        self.start()
+
+    def enqueue(self, poll_id):
+        """Queue a recount for poll, unless one is already waiting."""
+        with self.lock:
+            if poll_id in self.pending:
+                return
+            self.pending.add(poll_id)
+        self.queue.put(poll_id)
+
+    def sweep(self):
+        """Queue recounts for every poll whose stored results are behind.
+
+        That's open early-results polls with new votes, and closed polls
+        whose final count failed.
+        """
+        for row in db_funcs.get_stale_early_results_polls():
+            self.enqueue(row["id"])
+        for row in db_funcs.get_unfinalised_closed_polls():
+            self.enqueue(row["id"])
+
+    def run_one(self, poll_id):
+        """Recount a single poll inside an app context."""
+        try:
+            with self.app.app_context():
+                self.recount(poll_id)
+        except Exception:
+            self.app.logger.exception("Recount failed for poll {0}"
+                                      .format(poll_id))
+        finally:
+            with self.lock:
+                self.pending.discard(poll_id)
+
+    def run_pending(self):
+        """Recount every queued poll, returning once the queue is empty."""
+        while True:
+            try:
+                poll_id = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.run_one(poll_id)
+
+    def start(self):
+        """Start the in-process worker thread, if not already running."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name="results-worker",
+                                           daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.run_one(self.queue.get())
+
+
+def get_worker():
+    """Return the results worker for the current app."""
+    return current_app.extensions["results_worker"]
+
+
+@click.command("results-worker")
+@click.option("--once", is_flag=True,
+              help="Recount polls with stale results once and exit.")
+@with_appcontext
+def results_worker_command(once):
+    """Recount polls with stale results every UPDATE_INTERVAL seconds."""
+    results_worker = get_worker()
+    while True:
+        results_worker.sweep()
+        results_worker.run_pending()
+        if once:
+            return
+        time.sleep(current_app.config["UPDATE_INTERVAL"])
+
+
+def init_app(app, recount):
+    app.extensions["results_worker"] = ResultsWorker(app, recount)
+    app.cli.add_command(results_worker_command)